@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+""" Benchmark suite: compile every combination of program, N and
+compile.sh flags, run it on a local MP-SPDZ protocol, and write one row
+per run to CSV and JSON. A previous JSON output can be given as baseline
+to print the relative changes. """
+
+import sys
+import os
+import re
+import csv
+import json
+import time
+import shutil
+import itertools
+import subprocess
+from getopt import getopt
+
+programs = ['pqueue_test.c', 'dijkstra.c', 'binsearch.c', 'sort.c', \
+            'strmatch.c']
+sizes = [10, 100]
+# every subset of these flags is benchmarked
+flags = ['-p', '-g', '-O']
+mp_spdz = 'mp-spdz'
+protocol = 'rep-field'
+compile_args = []
+output = 'bench'
+baseline = None
+
+fields = ['program', 'N', 'flags', 'status', 'compile time', \
+          'MP-SPDZ compile time', 'instructions', 'n_vars', 'ticks', \
+          'wall time', 'time', 'data sent', 'global data sent', 'rounds', \
+          'result']
+# compared with the baseline
+metrics = ['instructions', 'n_vars', 'ticks', 'wall time', 'data sent', \
+           'global data sent', 'rounds']
+patterns = {
+    'ticks': r'Ticks: (\d+)',
+    'time': r'Time = ([\d.e+-]+) seconds',
+    'data sent': r'Data sent = ([\d.e+-]+) MB',
+    'global data sent': r'Global data sent = ([\d.e+-]+) MB',
+    'rounds': r'in ~(\d+) rounds',
+    'result': r'(\S+) \?= ',
+}
+
+def number(x):
+    try:
+        return int(x)
+    except ValueError:
+        return float(x)
+
+def timed(args, **kwargs):
+    start = time.time()
+    res = subprocess.run(args, stdout=subprocess.PIPE, \
+                         stderr=subprocess.STDOUT, universal_newlines=True, \
+                         **kwargs)
+    return time.time() - start, res
+
+def run(program, N, flag_set):
+    row = {'program': program, 'N': N, 'flags': ' '.join(flag_set), \
+           'status': 'ok'}
+    # without the cache to measure the whole compilation
+    source = os.path.join(mp_spdz, 'Programs', 'Source')
+    row['compile time'], res = timed(['./compile.sh', '-C'] + \
+                                     list(flag_set) + \
+                                     ['-N', str(N), '-o', source, program])
+    if res.returncode:
+        row['status'] = 'compile.sh failed'
+        print(res.stdout, file=sys.stderr)
+        return row
+    name = re.search(r'^name: (\S+)$', res.stdout, re.M).group(1)
+    with open(os.path.join(source, name + '.mpc')) as mpc:
+        text = mpc.read()
+    row['instructions'] = len(re.findall(r', # \d+$', text, re.M))
+    row['n_vars'] = int(re.search(r'^n_vars = (\d+)$', text, re.M).group(1))
+    row['MP-SPDZ compile time'], res = \
+        timed(['./compile.py'] + compile_args + [name], cwd=mp_spdz)
+    if res.returncode:
+        row['status'] = 'compile.py failed'
+        print(res.stdout, file=sys.stderr)
+        return row
+    row['wall time'], res = timed(['Scripts/%s.sh' % protocol, name], \
+                                  cwd=mp_spdz)
+    if res.returncode:
+        row['status'] = 'run failed'
+        print(res.stdout, file=sys.stderr)
+    for field,pattern in patterns.items():
+        match = re.search(pattern, res.stdout)
+        if match:
+            row[field] = match.group(1) if field == 'result' \
+                else number(match.group(1))
+    return row
+
+def compare(rows, baseline_rows):
+    key = lambda row: (row['program'], row['N'], row['flags'])
+    before = dict((key(row), row) for row in baseline_rows)
+    for row in rows:
+        old = before.get(key(row))
+        if old is None:
+            continue
+        if old.get('result') != row.get('result'):
+            print('%s N=%d %s: result %s -> %s' % \
+                  (key(row) + (old.get('result'), row.get('result'))))
+        for metric in metrics:
+            x, y = old.get(metric), row.get(metric)
+            if x and y is not None and x != y:
+                print('%s N=%d %s: %s %g -> %g (%+.1f%%)' % \
+                      (key(row) + (metric, x, y, 100. * (y - x) / x)))
+
+opts, args = getopt(sys.argv[1:], 'N:f:m:s:c:o:b:')
+
+for opt,value in opts:
+    if opt == '-N':
+        sizes = [int(x) for x in value.split(',')]
+    elif opt == '-f':
+        flags = value.split()
+    elif opt == '-m':
+        mp_spdz = value
+    elif opt == '-s':
+        protocol = value
+    elif opt == '-c':
+        compile_args = value.split()
+    elif opt == '-o':
+        output = value
+    elif opt == '-b':
+        baseline = value
+
+if args:
+    programs = args
+
+# benchmark the machine in this tree
+shutil.copy('machine.py', os.path.join(mp_spdz, 'Compiler'))
+
+rows = []
+for program in programs:
+    for N in sizes:
+        for n_flags in range(len(flags) + 1):
+            for flag_set in itertools.combinations(flags, n_flags):
+                row = run(program, N, flag_set)
+                print(json.dumps(row, sort_keys=True), file=sys.stderr)
+                rows.append(row)
+
+with open(output + '.csv', 'w') as out:
+    writer = csv.DictWriter(out, fields)
+    writer.writeheader()
+    writer.writerows(rows)
+
+with open(output + '.json', 'w') as out:
+    json.dump(rows, out, indent=1, sort_keys=True)
+
+if baseline:
+    compare(rows, json.load(open(baseline)))
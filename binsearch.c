@@ -0,0 +1,27 @@
+#include <stdio.h>
+#include <signal.h>
+
+int main() {
+  int a[N];
+
+  for (int i = 0; i < N; i++)
+    a[i] = 2 * i;
+
+  int key = 2 * (N / 3);
+  int lo = 0, hi = N;
+  while (lo < hi) {
+    int mid = (lo + hi) / 2;
+    if (a[mid] < key)
+      lo = mid + 1;
+    else
+      hi = mid;
+  }
+
+#ifdef DEBUG
+  printf("%d: %d\n", lo, a[lo]);
+  if (lo != N / 3)
+    raise(SIGABRT);
+#endif
+
+  return lo;
+}
@@ -2,8 +2,26 @@
 
 data_type=sint
 oram_type=OptimalORAM
+cache_dir=${C2MPC_CACHE:-${XDG_CACHE_HOME:-$HOME/.cache}/c2mpc}
+# bound on the cache size in KiB
+cache_size=${C2MPC_CACHE_SIZE:-102400}
+use_cache=1
+resume=False
 
-while getopts OgN:I:rapi:o: opt; do
+hash() {
+    sha256sum | cut -c-64
+}
+
+evict() {
+    # remove the least recently used entries beyond the size bound
+    while test $(du -sk $cache_dir | cut -f1) -gt $cache_size; do
+	oldest=$(ls -tr $cache_dir | head -1)
+	test "$oldest" || break
+	rm -f $cache_dir/$oldest
+    done
+}
+
+while getopts OgN:I:rapi:o:sPk:b:cmRt:w:exnCBjT:lK:zSvdf opt; do
     case $opt in
         O) optimize=1 ;;
 	g) data_type=sgf2nint32
@@ -11,7 +29,7 @@ while getopts OgN:I:rapi:o: opt; do
 	    ;;
 	N) N=$OPTARG
 	    clang_args="$clang_args -DN=$OPTARG"
-	    mcomp_args="-N $OPTARG"
+	    mcomp_args="$mcomp_args -N $OPTARG"
 	    ;;
 	I) init_string=$OPTARG ;;
 	r) regexp=1 ;;
@@ -21,11 +39,56 @@ while getopts OgN:I:rapi:o: opt; do
 	    ;;
 	i) inc_init=$OPTARG ;;
 	o) out_dir=$OPTARG ;;
+	s) shared_alu=1
+	    shared=-s
+	    ;;
+	P) prefix=-P ;;
+	k) check_interval=$OPTARG ;;
+	b) max_steps=$OPTARG ;;
+	c) public_code=1 ;;
+	m) oram_type=AutoORAM
+	    packed=-m
+	    ;;
+	R) split=-R ;;
+	t) registers="-T $OPTARG"
+	    tiered=-t$OPTARG
+	    ;;
+	w) bundles="-W $OPTARG"
+	    vliw=-w$OPTARG
+	    ;;
+	e) profile=-E ;;
+	x) binary=1
+	    bin=-x
+	    ;;
+	n) narrow=-n ;;
+	C) use_cache= ;;
+	B) use_image=1 ;;
+	j) telemetry=1 ;;
+	T) n_threads=$OPTARG ;;
+	l) overlap_fetch=1 ;;
+	K) checkpoint_interval=$OPTARG ;;
+	z) resume=True
+	    resumed=-z
+	    ;;
+	S) text_ir=1 ;;
+	v) mcomp_args="$mcomp_args -v" ;;
+	d) mcomp_args="$mcomp_args -O" ;;
+	f) mcomp_args="$mcomp_args -f" ;;
     esac
 done
 
 shift $[OPTIND-1]
 
+if test "$split" && test "$init_string" -o "$inc_init"; then
+    echo "-R cannot be combined with -I or -i" > /dev/stderr
+    exit 1
+fi
+
+if test "$registers" && test "$init_string" -o "$inc_init"; then
+    echo "-t cannot be combined with -I or -i" > /dev/stderr
+    exit 1
+fi
+
 if test "$regexp"; then
     name=${1%.re}
     prog=$name.c
@@ -33,69 +96,191 @@ if test "$regexp"; then
     cp $1 $1.$(date +%y%m%d-%H%M)
 else
     prog=$1
-    name=$1$N$gf2n$packed
+    name=$1$N$gf2n$packed$shared$split$tiered$vliw$bin$narrow$resumed
 fi
 
 if test "$asm_output"; then
     mpc_file=/dev/stdout
 else
-    mpc_file=${out_dir:-.}/$name.mpc
+    # only replaced if changed so that the MP-SPDZ compilation of an
+    # unchanged file stays valid
+    mpc_target=${out_dir:-.}/$name.mpc
+    mpc_file=$mpc_target.new
+    if test "$use_image"; then
+	# absolute because MP-SPDZ compiles from its own directory
+	image_file=$(cd ${out_dir:-.} && pwd)/$name.code
+	image="-B $image_file"
+    fi
 fi
 
 
 echo name: $name > /dev/stderr
 echo prog: $prog > /dev/stderr
-echo mpc_file: $mpc_file > /dev/stderr
+echo mpc_file: ${mpc_target:-$mpc_file} > /dev/stderr
 
-clang $clang_args -emit-llvm -c $prog
-
-object=${prog%c}o
+if test "$text_ir"; then
+    object=${prog%c}ll
+else
+    object=${prog%c}o
+fi
 
 OPT=${OPT:-opt}
 
-if test $optimize; then
-    $OPT -lowerswitch -targetlibinfo -no-aa -tbaa -basicaa -notti -globalopt -ipsccp -deadargelim -basiccg -prune-eh -inline-cost -inline -functionattrs -domtree -early-cse -simplify-libcalls -lazy-value-info -tailcallelim -reassociate -domtree -loops -loop-simplify -licm -scalar-evolution -loop-simplify -memdep -memdep -memcpyopt -sccp -lazy-value-info -domtree -memdep -dse -adce -strip-dead-prototypes -globaldce -preverify -domtree -verify $object > $object.opt
-else
-    $OPT -lowerswitch $object > $object.opt
+if test "$use_cache"; then
+    mkdir -p $cache_dir
+    # the preprocessed source covers included files
+    bc_key=$({ clang $clang_args -E $prog; \
+	echo $clang_args $optimize $text_ir; clang --version; \
+	$OPT --version; } 2> /dev/null | hash)
+    mc_key=$({ echo $bc_key $mcomp_args $asm_output $prefix $split \
+	$registers $bundles $profile $image; \
+	cat mcompile.py llvmtext.py; } | hash)
 fi
 
-mv $object.opt $object
+if test "$use_cache" && test -f $cache_dir/$bc_key.o; then
+    echo "cache hit: $object" > /dev/stderr
+    cp $cache_dir/$bc_key.o $object
+    touch $cache_dir/$bc_key.o
+else
+    test "$use_cache" && echo "cache miss: $object" > /dev/stderr
+    if test "$text_ir"; then
+	# textual IR of a recent clang, optimized by clang itself
+	if test $optimize; then
+	    clang $clang_args -S -emit-llvm -O2 -fno-vectorize \
+		-fno-slp-vectorize -fno-unroll-loops $prog
+	else
+	    clang $clang_args -S -emit-llvm -Xclang -disable-O0-optnone $prog
+	fi
+	# lowerswitch in older LLVM versions
+	$OPT -S -passes=lower-switch $object > $object.opt 2> /dev/null || \
+	    $OPT -S -passes=lowerswitch $object > $object.opt
+    else
+	clang $clang_args -emit-llvm -c $prog
+	if test $optimize; then
+	    $OPT -lowerswitch -targetlibinfo -no-aa -tbaa -basicaa -notti -globalopt -ipsccp -deadargelim -basiccg -prune-eh -inline-cost -inline -functionattrs -domtree -early-cse -simplify-libcalls -lazy-value-info -tailcallelim -reassociate -domtree -loops -loop-simplify -licm -scalar-evolution -loop-simplify -memdep -memdep -memcpyopt -sccp -lazy-value-info -domtree -memdep -dse -adce -strip-dead-prototypes -globaldce -preverify -domtree -verify $object > $object.opt
+	else
+	    $OPT -lowerswitch $object > $object.opt
+	fi
+    fi
+    mv $object.opt $object
+    if test "$use_cache"; then
+	cp $object $cache_dir/$bc_key.o
+    fi
+fi
 
 if ! test "$asm_output"; then
     cat > $mpc_file <<EOF
 from machine import *
+import machine
 import oram
 #oram.optimal_threshold = 2**12
 oram.use_insecure_randomness = True
 EOF
+    if test "$shared_alu"; then
+	echo "machine.shared_alu = True" >> $mpc_file
+    fi
+    if test "$check_interval"; then
+	echo "machine.check_interval = $check_interval" >> $mpc_file
+    fi
+    if test "$max_steps"; then
+	echo "machine.max_steps = $max_steps" >> $mpc_file
+    fi
+    if test "$public_code"; then
+	echo "machine.public_code = True" >> $mpc_file
+    fi
+    if test "$binary"; then
+	echo "machine.binary_ops = True" >> $mpc_file
+    fi
+    if test "$telemetry"; then
+	# absolute because MP-SPDZ compiles from its own directory
+	report=$(cd ${out_dir:-.} && pwd)/$name.telemetry.json
+	echo "machine.telemetry = '$report'" >> $mpc_file
+    fi
+    if test "$n_threads"; then
+	echo "machine.n_threads = $n_threads" >> $mpc_file
+    fi
+    if test "$overlap_fetch"; then
+	echo "machine.overlap_fetch = True" >> $mpc_file
+    fi
+    if test "$checkpoint_interval"; then
+	echo "machine.checkpoint_interval = $checkpoint_interval" >> $mpc_file
+    fi
 fi
 
-echo "Compiling $object to $mpc_file" > /dev/stderr
-./mcompile.py $mcomp_args $asm_output $object >> $mpc_file
+echo "Compiling $object to ${mpc_target:-$mpc_file}" > /dev/stderr
+if test "$use_cache" && test -f $cache_dir/$mc_key.out && \
+    test -z "$image_file" -o -f $cache_dir/$mc_key.code; then
+    echo "cache hit: mcompile.py output" > /dev/stderr
+    touch $cache_dir/$mc_key.out $cache_dir/$mc_key.err
+    if test "$image_file"; then
+	cp $cache_dir/$mc_key.code $image_file
+    fi
+    cat $cache_dir/$mc_key.err > /dev/stderr
+    cat $cache_dir/$mc_key.out >> $mpc_file
+elif test "$use_cache"; then
+    echo "cache miss: mcompile.py output" > /dev/stderr
+    if ./mcompile.py $mcomp_args $asm_output $prefix $split $registers \
+	$bundles $profile $image $object > $cache_dir/$mc_key.tmp \
+	2> $cache_dir/$mc_key.err; then
+	if test "$image_file"; then
+	    cp $image_file $cache_dir/$mc_key.code
+	fi
+	mv $cache_dir/$mc_key.tmp $cache_dir/$mc_key.out
+	cat $cache_dir/$mc_key.err > /dev/stderr
+	cat $cache_dir/$mc_key.out >> $mpc_file
+    else
+	cat $cache_dir/$mc_key.err > /dev/stderr
+	rm -f $cache_dir/$mc_key.tmp $cache_dir/$mc_key.err
+	test "$mpc_target" && rm -f $mpc_file
+	exit 1
+    fi
+    evict
+else
+    ./mcompile.py $mcomp_args $asm_output $prefix $split $registers $bundles \
+	$profile $image $object >> $mpc_file
+fi
 
 if ! test "$asm_output"; then
+    if test "$narrow"; then
+	echo "machine.bit_lengths = bit_lengths" >> $mpc_file
+    fi
     if test "$init_string" -o "$inc_init"; then
-	cat >> $mpc_file <<EOF
-data = $oram_type(n_vars, $data_type.basic_type, entry_size=(32,))
-EOF
 	if test "$init_string"; then
 	    cat >> $mpc_file <<EOF
-for i,c in enumerate("$init_string"):
-    data[i] = ord(c)
+initial_data = dict(list(enumerate(map(ord, "$init_string"))) + \\
+    list(initial_data.items()))
 EOF
 	elif test "$inc_init"; then
 	    cat >> $mpc_file <<EOF
-for i in range($inc_init):
-    data[i] = i
+initial_data = dict([(i, i) for i in range($inc_init)] + \\
+    list(initial_data.items()))
 EOF
 	fi
 	cat >> $mpc_file <<EOF
-run_code_with_data(code, data, start, $data_type, oram_type=$oram_type)
+data = $oram_type(n_vars, $data_type.basic_type, entry_size=(32,))
+EOF
+	cat >> $mpc_file <<EOF
+run_code_with_data(code, data, start, $data_type, oram_type=$oram_type, \
+    initial_data=initial_data, inputs=inputs, resume=$resume)
 EOF
     else
-	echo "data = run_code(code, n_vars, start, n_global_vars, \
-    $data_type, oram_type=$oram_type)" >> $mpc_file
+	run_code=run_code
+	test $resume = True && run_code=resume_code
+	echo "data = $run_code(code, n_vars, start, n_global_vars, \
+    $data_type, oram_type=$oram_type, initial_data=initial_data, \
+    n_array_vars=n_array_vars, n_registers=n_registers, \
+    initial_registers=initial_registers, inputs=inputs, \
+    global_cells=global_cells)" >> $mpc_file
     fi
 
     echo "print_ln('%s ?= %s', data[check].reveal(), ${2:-1})" >> $mpc_file
 fi
+
+if test "$mpc_target"; then
+    if cmp -s $mpc_file $mpc_target; then
+	rm $mpc_file
+	echo "$mpc_target unchanged" > /dev/stderr
+    else
+	mv $mpc_file $mpc_target
+    fi
+fi
@@ -0,0 +1,23 @@
+/* Global input read both through pointers and directly, with a call
+   that reads input before anything else. */
+
+int n;
+int in[N];
+
+int twice(int x) {
+  return x + x;
+}
+
+int scaled() {
+  return n * 7;
+}
+
+int main() {
+  int mul = scaled();
+  int sum = twice(5);
+
+  for (int i = 0; i < N; i++)
+    sum += twice(in[i]);
+
+  return sum - mul;
+}
@@ -0,0 +1,637 @@
+""" Reader for textual LLVM IR (.ll) from recent versions of clang.
+It builds objects with the part of the llvmpy interface that mcompile.py
+uses, so mcompile.py runs without llvmpy and on the output of current
+optimization pipelines. Pointers may be typed or opaque. Instructions
+with several indices or byte offsets are split into getelementptr steps
+as emitted by clang 3.3, each with the indexed type in source_type. """
+
+import re
+
+__all__ = ['Module', 'IntegerType', 'PointerType', 'ArrayType', \
+           'StructType', 'FunctionType', 'ConstantInt', 'ConstantExpr', \
+           'ConstantAggregateZero', 'ConstantDataArray', 'ConstantArray', \
+           'ConstantStruct', 'Argument', 'ICMP_EQ', 'ICMP_NE', 'ICMP_UGT', \
+           'ICMP_UGE', 'ICMP_ULT', 'ICMP_ULE', 'ICMP_SGT', 'ICMP_SGE', \
+           'ICMP_SLT', 'ICMP_SLE']
+
+ICMP_EQ, ICMP_NE, ICMP_UGT, ICMP_UGE, ICMP_ULT, ICMP_ULE, ICMP_SGT, \
+    ICMP_SGE, ICMP_SLT, ICMP_SLE = range(32, 42)
+
+predicates = {'eq': ICMP_EQ, 'ne': ICMP_NE, 'ugt': ICMP_UGT, \
+              'uge': ICMP_UGE, 'ult': ICMP_ULT, 'ule': ICMP_ULE, \
+              'sgt': ICMP_SGT, 'sge': ICMP_SGE, 'slt': ICMP_SLT, \
+              'sle': ICMP_SLE}
+
+binary_ops = ('add', 'sub', 'mul', 'and', 'or', 'xor', 'shl', 'ashr', \
+              'lshr', 'udiv', 'sdiv', 'urem', 'srem')
+casts = ('zext', 'sext', 'trunc', 'bitcast', 'inttoptr', 'ptrtoint', \
+         'addrspacecast')
+# keywords between an opcode and its operands that do not matter here
+flags = ('nuw', 'nsw', 'exact', 'inbounds', 'nusw', 'volatile', 'nneg', \
+         'disjoint', 'samesign', 'tail', 'musttail', 'notail')
+
+token_re = re.compile(r'\s*(?:;.*|(c?"[^"]*"|[%@]"[^"]*"|[%@!#]?[-\w.$]+|' \
+                      r'\.\.\.|\S))')
+
+def tokenize(line):
+    return [x for x in token_re.findall(line) if x]
+
+class IntegerType(object):
+    def __init__(self, width):
+        self.width = width
+    def __str__(self):
+        return 'i%d' % self.width
+
+class PointerType(object):
+    """ pointee is None for an opaque pointer of unknown use. """
+    def __init__(self, pointee=None):
+        self.pointee = pointee
+    def __str__(self):
+        return 'ptr' if self.pointee is None else '%s*' % self.pointee
+
+class ArrayType(object):
+    def __init__(self, element, count):
+        self.element = element
+        self.count = count
+    def __str__(self):
+        return '[%d x %s]' % (self.count, self.element)
+
+class StructType(object):
+    def __init__(self, elements=None, packed=False, name=None):
+        self.elements = elements or []
+        self.packed = packed
+        self.name = name
+    def __str__(self):
+        return self.name or '{ %s }' % ', '.join(map(str, self.elements))
+
+class FunctionType(object):
+    def __init__(self, return_type, args):
+        self.return_type = return_type
+        self.args = args
+
+class VoidType(object):
+    __str__ = lambda self: 'void'
+
+class LabelType(object):
+    __str__ = lambda self: 'label'
+
+def byte_size(t):
+    if isinstance(t, IntegerType):
+        return max(1, (t.width + 7) // 8)
+    elif isinstance(t, PointerType):
+        return 8
+    elif isinstance(t, ArrayType):
+        return t.count * byte_size(t.element)
+    elif isinstance(t, StructType):
+        offsets = field_offsets(t)
+        size = offsets[-1] + byte_size(t.elements[-1]) if t.elements else 0
+        return -(-size // alignment(t)) * alignment(t)
+    else:
+        raise Exception('type not implemented: %s' % t)
+
+def alignment(t):
+    if isinstance(t, ArrayType):
+        return alignment(t.element)
+    elif isinstance(t, StructType):
+        if t.packed:
+            return 1
+        return max([alignment(x) for x in t.elements] + [1])
+    else:
+        return byte_size(t)
+
+def field_offsets(t):
+    res = []
+    offset = 0
+    for x in t.elements:
+        if not t.packed:
+            offset = -(-offset // alignment(x)) * alignment(x)
+        res.append(offset)
+        offset += byte_size(x)
+    return res
+
+def byte_path(t, offset):
+    """ Indices of the element at a byte offset in t. """
+    res = []
+    while offset:
+        if isinstance(t, ArrayType):
+            size = byte_size(t.element)
+            res.append(offset // size)
+            offset %= size
+            t = t.element
+        elif isinstance(t, StructType):
+            offsets = field_offsets(t)
+            i = max(i for i,x in enumerate(offsets) if x <= offset)
+            res.append(i)
+            offset -= offsets[i]
+            t = t.elements[i]
+        else:
+            raise Exception('not implemented: byte offset %d in %s' % \
+                            (offset, t))
+    return res
+
+def index_type(t, index):
+    if isinstance(t, ArrayType):
+        return t.element
+    elif isinstance(t, StructType):
+        return t.elements[index.s_ext_value]
+    else:
+        raise Exception('not implemented: index into %s' % t)
+
+class Value(object):
+    opcode_name = None
+    operands = []
+    name = ''
+
+class ConstantInt(Value):
+    def __init__(self, type, value):
+        self.type = type
+        self.s_ext_value = value
+    def __str__(self):
+        return '%s %d' % (self.type, self.s_ext_value)
+
+class ConstantAggregateZero(Value):
+    def __init__(self, type):
+        self.type = type
+
+def decode_string(text):
+    """ Signed bytes of a c"..." constant. """
+    body = text[2:-1]
+    res = []
+    i = 0
+    while i < len(body):
+        if body[i] == '\\':
+            x = int(body[i + 1:i + 3], 16)
+            i += 3
+        else:
+            x = ord(body[i])
+            i += 1
+        res.append(x - 256 if x > 127 else x)
+    return res
+
+class ConstantDataArray(Value):
+    """ String constant with its characters as operands. """
+    def __init__(self, type, text):
+        self.type = type
+        self.text = text
+        self.operands = [ConstantInt(type.element, x) \
+                             for x in decode_string(text)]
+    def __str__(self):
+        return '%s %s' % (self.type, self.text)
+
+class ConstantArray(Value):
+    def __init__(self, type, operands):
+        self.type = type
+        self.operands = operands
+
+class ConstantStruct(ConstantArray):
+    pass
+
+class ConstantExpr(Value):
+    def __init__(self, opcode_name, operands, type, source_type=None):
+        self.opcode_name = opcode_name
+        self.operands = operands
+        self.type = type
+        if source_type is not None:
+            self.source_type = source_type
+
+class GlobalVariable(Value):
+    def __init__(self, name):
+        self.name = name
+
+class Argument(Value):
+    def __init__(self, type, name):
+        self.type = type
+        self.name = name
+
+class BasicBlock(Value):
+    def __init__(self, name):
+        self.name = name
+        self.instructions = []
+        self.type = LabelType()
+
+class Function(Value):
+    def __init__(self, name, return_type, args):
+        self.name = name
+        self.args = args
+        self.type = PointerType(FunctionType(return_type, \
+                                             [arg.type for arg in args]))
+        self.basic_blocks = []
+
+class Instruction(Value):
+    def __init__(self):
+        self.operands = []
+        self.type = None
+    called_function = property(lambda self: self.operands[-1])
+    incoming_count = property(lambda self: len(self.incoming))
+    def get_incoming_value(self, i):
+        return self.incoming[i][0]
+    def get_incoming_block(self, i):
+        return self.incoming[i][1]
+
+def top_level_split(tokens):
+    """ Split at commas outside of brackets. """
+    res = [[]]
+    depth = 0
+    for x in tokens:
+        if x in ('(', '[', '{', '<'):
+            depth += 1
+        elif x in (')', ']', '}', '>'):
+            depth -= 1
+        if x == ',' and depth == 0:
+            res.append([])
+        else:
+            res[-1].append(x)
+    return res
+
+class Parser(object):
+    def __init__(self, tokens, module, local_values={}):
+        self.tokens = tokens
+        self.i = 0
+        self.module = module
+        self.local_values = local_values
+    def peek(self):
+        return self.tokens[self.i] if self.i < len(self.tokens) else None
+    def next(self):
+        self.i += 1
+        return self.tokens[self.i - 1]
+    def expect(self, token):
+        if self.next() != token:
+            raise Exception('expected %s: %s' % (token, ' '.join(self.tokens)))
+    def skip(self, words):
+        while self.peek() in words:
+            self.next()
+    def type(self):
+        x = self.next()
+        if x == '[':
+            count = int(self.next())
+            self.expect('x')
+            res = ArrayType(self.type(), count)
+            self.expect(']')
+        elif x == '{' or x == '<' and self.peek() == '{':
+            packed = x == '<'
+            if packed:
+                self.next()
+            elements = []
+            while self.peek() != '}':
+                elements.append(self.type())
+                if self.peek() == ',':
+                    self.next()
+            self.next()
+            if packed:
+                self.expect('>')
+            res = StructType(elements, packed)
+        elif x == 'ptr':
+            res = PointerType()
+        elif re.match(r'i\d+$', x):
+            res = IntegerType(int(x[1:]))
+        elif x == 'void':
+            res = VoidType()
+        elif x == 'label':
+            res = LabelType()
+        elif x in self.module.types:
+            res = self.module.types[x]
+        else:
+            raise Exception('type not implemented: %s' % x)
+        while self.peek() == '*':
+            self.next()
+            res = PointerType(res)
+        return res
+    def value(self, t):
+        x = self.next()
+        if x.startswith('%'):
+            return self.local_values[x]
+        elif x.startswith('@'):
+            return self.module.values[x]
+        elif re.match(r'-?\d+$', x):
+            return ConstantInt(t, int(x))
+        elif x in ('true', 'false'):
+            return ConstantInt(t, int(x == 'true'))
+        elif x in ('null', 'undef', 'poison'):
+            return ConstantInt(t, 0)
+        elif x == 'zeroinitializer':
+            return ConstantAggregateZero(t)
+        elif x.startswith('c"'):
+            return ConstantDataArray(t, x)
+        elif x in ('[', '{', '<'):
+            if x == '<':
+                self.expect('{')
+            operands = []
+            while self.peek() not in (']', '}'):
+                operands.append(self.typed_value())
+                if self.peek() == ',':
+                    self.next()
+            self.next()
+            if x == '<':
+                self.expect('>')
+            return (ConstantArray if x == '[' else ConstantStruct) \
+                (t, operands)
+        elif x == 'getelementptr':
+            self.skip(flags)
+            self.expect('(')
+            source = self.type()
+            self.expect(',')
+            base = self.typed_value()
+            indices = []
+            while self.peek() == ',':
+                self.next()
+                indices.append(self.typed_value())
+            self.expect(')')
+            if isinstance(source, IntegerType) and source.width == 8 and \
+               len(indices) == 1 and isinstance(base, GlobalVariable):
+                # byte offset into a global of known type
+                source = base.type.pointee
+                indices = [ConstantInt(IntegerType(64), i) for i in \
+                           [0] + byte_path(source, indices[0].s_ext_value)]
+            return ConstantExpr(x, [base] + indices, t, source)
+        elif x in casts:
+            self.expect('(')
+            operand = self.typed_value()
+            self.expect('to')
+            res = ConstantExpr(x, [operand], self.type())
+            self.expect(')')
+            return res
+        else:
+            raise Exception('value not implemented: %s' % x)
+    def typed_value(self):
+        return self.value(self.type())
+
+class Module(object):
+    """ Global variables and functions of a textual IR module. """
+    def __init__(self, text):
+        self.types = {}
+        self.values = {}
+        self.global_variables = []
+        self.functions = []
+        statements = []
+        depth = 0
+        for line in text.splitlines():
+            tokens = tokenize(line)
+            if depth:
+                statements[-1] += tokens
+            elif tokens:
+                statements.append(tokens)
+            depth += sum(x in ('(', '[') for x in tokens) - \
+                     sum(x in (')', ']') for x in tokens)
+        # types and globals may refer to later ones
+        for tokens in statements:
+            if tokens[0].startswith('%') and tokens[1:3] == ['=', 'type']:
+                self.types[tokens[0]] = StructType(name=tokens[0])
+        for tokens in statements:
+            if tokens[0].startswith('%') and tokens[1:3] == ['=', 'type'] \
+               and tokens[3] != 'opaque':
+                t = Parser(tokens[3:], self).type()
+                self.types[tokens[0]].elements = t.elements
+                self.types[tokens[0]].packed = t.packed
+        bodies = []
+        for i,tokens in enumerate(statements):
+            if tokens[0].startswith('@') and tokens[1] == '=':
+                var = GlobalVariable(tokens[0][1:].strip('"'))
+                self.values[tokens[0]] = var
+                self.global_variables.append(var)
+            elif tokens[0] in ('define', 'declare'):
+                function = self.function_header(tokens)
+                if tokens[0] == 'define':
+                    end = statements.index(['}'], i)
+                    bodies.append((function, statements[i + 1:end]))
+        for tokens in statements:
+            if tokens[0].startswith('@') and tokens[1] == '=':
+                self.global_variable(tokens)
+        for function,body in bodies:
+            self.function_body(function, body)
+    @classmethod
+    def from_assembly(cls, f):
+        return cls(f.read())
+    def global_variable(self, tokens):
+        var = self.values[tokens[0]]
+        keywords = [i for i,x in enumerate(tokens) if x in ('global', 'constant')]
+        if not keywords:
+            raise Exception('not implemented: %s' % ' '.join(tokens))
+        parser = Parser(tokens[keywords[0] + 1:], self)
+        t = parser.type()
+        var.type = PointerType(t)
+        var.global_constant = tokens[keywords[0]] == 'constant'
+        if parser.peek() in (None, ','):
+            # external, to be filled by input
+            var.initializer = ConstantAggregateZero(t)
+        else:
+            var.initializer = parser.value(t)
+    def function_header(self, tokens):
+        start = [i for i,x in enumerate(tokens) \
+                     if x.startswith('@') and tokens[i + 1] == '('][0]
+        for i in range(1, start):
+            try:
+                parser = Parser(tokens[i:start], self)
+                return_type = parser.type()
+                if parser.peek() is None:
+                    break
+            except Exception:
+                pass
+        else:
+            raise Exception('no return type: %s' % ' '.join(tokens))
+        end = start + 2
+        depth = 1
+        while depth:
+            depth += {'(': 1, ')': -1}.get(tokens[end], 0)
+            end += 1
+        args = []
+        for arg in top_level_split(tokens[start + 2:end - 1]):
+            if arg and arg != ['...']:
+                name = arg[-1] if arg[-1].startswith('%') else ''
+                args.append(Argument(Parser(arg, self).type(), name[1:]))
+        function = Function(tokens[start][1:].strip('"'), return_type, args)
+        self.values[tokens[start]] = function
+        self.functions.append(function)
+        return function
+    def function_body(self, function, statements):
+        local_values = dict(('%' + arg.name, arg) for arg in function.args)
+        blocks = []
+        for tokens in statements:
+            if len(tokens) == 2 and tokens[1] == ':':
+                blocks.append(BasicBlock(tokens[0].strip('"')))
+                local_values['%' + blocks[-1].name] = blocks[-1]
+            elif len(tokens) > 1 and tokens[1] == '=':
+                local_values[tokens[0]] = Instruction()
+        block = None
+        for tokens in statements:
+            if len(tokens) == 2 and tokens[1] == ':':
+                block = local_values['%' + tokens[0].strip('"')]
+                function.basic_blocks.append(block)
+                continue
+            if block is None:
+                # unnamed entry block
+                block = BasicBlock('')
+                function.basic_blocks.append(block)
+            if tokens[1] == '=':
+                inst = local_values[tokens[0]]
+                tokens = tokens[2:]
+            else:
+                inst = Instruction()
+            # drop metadata attachments
+            for i in range(len(tokens) - 1):
+                if tokens[i] == ',' and tokens[i + 1].startswith('!'):
+                    tokens = tokens[:i]
+                    break
+            parser = Parser(tokens, self, local_values)
+            block.instructions += self.instruction(parser, inst)
+    def instruction(self, parser, inst):
+        """ Fill inst from the tokens. Returns the instructions to
+        append, which are more than one for split getelementptr. """
+        parser.skip(flags)
+        op = inst.opcode_name = parser.next()
+        parser.skip(flags)
+        if op == 'alloca':
+            inst.type = PointerType(parser.type())
+        elif op == 'load':
+            inst.type = parser.type()
+            parser.expect(',')
+            inst.operands = [parser.typed_value()]
+        elif op == 'store':
+            inst.operands = [parser.typed_value()]
+            parser.expect(',')
+            inst.operands.append(parser.typed_value())
+        elif op in binary_ops:
+            inst.type = parser.type()
+            inst.operands = [parser.value(inst.type)]
+            parser.expect(',')
+            inst.operands.append(parser.value(inst.type))
+        elif op == 'icmp':
+            inst.predicate = predicates[parser.next()]
+            t = parser.type()
+            inst.operands = [parser.value(t)]
+            parser.expect(',')
+            inst.operands.append(parser.value(t))
+            inst.type = IntegerType(1)
+        elif op in casts:
+            inst.operands = [parser.typed_value()]
+            parser.expect('to')
+            inst.type = parser.type()
+        elif op == 'getelementptr':
+            source = parser.type()
+            parser.expect(',')
+            base = parser.typed_value()
+            indices = []
+            while parser.peek() == ',':
+                parser.next()
+                indices.append(parser.typed_value())
+            return self.getelementptr(inst, source, base, indices)
+        elif op == 'br':
+            if parser.peek() == 'label':
+                inst.operands = [parser.typed_value()]
+            else:
+                condition = parser.typed_value()
+                parser.expect(',')
+                true = parser.typed_value()
+                parser.expect(',')
+                inst.operands = [condition, parser.typed_value(), true]
+        elif op == 'ret':
+            if parser.peek() == 'void':
+                inst.operands = []
+            else:
+                inst.operands = [parser.typed_value()]
+        elif op == 'phi':
+            inst.type = parser.type()
+            inst.incoming = []
+            while parser.peek() == '[':
+                parser.next()
+                value = parser.value(inst.type)
+                parser.expect(',')
+                inst.incoming.append((value, parser.value(LabelType())))
+                parser.expect(']')
+                if parser.peek() == ',':
+                    parser.next()
+        elif op == 'call':
+            tokens = parser.tokens
+            start = [i for i,x in enumerate(tokens) \
+                         if x[:1] in '%@' and tokens[i + 1:i + 2] == ['(']][0]
+            if tokens[start].startswith('%'):
+                raise Exception('not implemented: indirect call')
+            function = self.values[tokens[start]]
+            inst.type = function.type.pointee.return_type
+            inst.operands = [function]
+            if function.name.startswith('llvm.'):
+                # ignored by mcompile.py
+                return [inst]
+            args = top_level_split(tokens[start + 2:len(tokens) - \
+                                          tokens[::-1].index(')') - 1])
+            for arg in args:
+                if not arg:
+                    continue
+                t = Parser(arg, self).type()
+                # the value follows the parameter attributes
+                starts = [i for i,x in enumerate(arg) \
+                              if x in casts + ('getelementptr',)]
+                arg = arg[starts[0]:] if starts else arg[-1:]
+                inst.operands.insert(-1, Parser(arg, self, \
+                                                parser.local_values).value(t))
+        elif op == 'select':
+            condition = parser.typed_value()
+            parser.expect(',')
+            t = parser.type()
+            true = parser.value(t)
+            parser.expect(',')
+            parser.type()
+            return self.select(inst, t, condition, true, parser.value(t))
+        else:
+            # rejected by mcompile.py
+            inst.operands = []
+        return [inst]
+    def select(self, inst, t, condition, true, false):
+        """ false + condition * (true - false) because mcompile.py
+        has no select, which optimization passes emit frequently. """
+        def new(op, operands):
+            res = Instruction()
+            res.opcode_name = op
+            res.operands = operands
+            res.type = t
+            return res
+        res = []
+        if isinstance(true, ConstantInt) and isinstance(false, ConstantInt):
+            difference = ConstantInt(t, true.s_ext_value - false.s_ext_value)
+        else:
+            difference = new('sub', [true, false])
+            res.append(difference)
+        flag = new('zext', [condition])
+        product = new('mul', [flag, difference])
+        inst.opcode_name = 'add'
+        inst.operands = [product, false]
+        inst.type = t
+        return res + [flag, product, inst]
+    def getelementptr(self, inst, source, base, indices):
+        """ Steps with one index into the type of the previous step,
+        after a first one over the whole source type if needed. """
+        pointee = getattr(base.type, 'pointee', None)
+        if isinstance(source, IntegerType) and source.width == 8 and \
+           len(indices) == 1 and isinstance(indices[0], ConstantInt) and \
+           pointee is not None and not (isinstance(pointee, IntegerType) and \
+                                        pointee.width == 8):
+            # byte offset into a value of known type
+            offset = indices[0].s_ext_value
+            source = pointee
+            indices = [ConstantInt(IntegerType(64), i) for i in \
+                       [offset // byte_size(source)] + \
+                       byte_path(source, offset % byte_size(source))]
+        zero = ConstantInt(IntegerType(64), 0)
+        # (indexed type, indices, type pointed to by the result)
+        steps = []
+        first = indices[0]
+        if not isinstance(first, ConstantInt) or first.s_ext_value != 0:
+            if isinstance(source, (ArrayType, StructType)):
+                steps.append((ArrayType(source, 0), [zero, first], source))
+            else:
+                steps.append((source, [first], source))
+        t = source
+        for index in indices[1:]:
+            steps.append((t, [zero, index], index_type(t, index)))
+            t = steps[-1][2]
+        if not steps:
+            steps.append((source, [zero], source))
+        res = []
+        for i,(step_type, step_indices, pointee) in enumerate(steps):
+            step = inst if i == len(steps) - 1 else Instruction()
+            step.opcode_name = 'getelementptr'
+            step.operands = [base] + step_indices
+            step.source_type = step_type
+            step.type = PointerType(pointee)
+            res.append(step)
+            base = step
+        return res
@@ -2,11 +2,49 @@ from Compiler.types import *
 from Compiler.oram import *
 from Compiler.path_oram import OptimalORAM
 from Compiler import oram
+import math
+import struct
+import json
 
 debug = False
 do_tick = True
+shared_alu = False
+# reveal termination only every check_interval steps, or never
+# if a public bound on the number of steps is given; then all max_steps
+# steps run, halted instances continue with no-op steps, which count as
+# ticks, and not_done is left secret
+check_interval = 1
+max_steps = None
+# number of instances still running after max_steps steps, secret
+not_done = None
+# keep the public code in a constant table instead of an ORAM
+public_code = False
+# compute the bitwise opcodes on bit decompositions shared in a step
+binary_ops = False
+# file to write a JSON report of the timers per phase and the static
+# costs per step to at compile time; telemetry.py adds the times,
+# communication and steps from the output of a run; no ticks are printed
+# then, and it costs nothing at run time if None
+telemetry = None
+# phases and the MP-SPDZ timers measuring them
+phases = {'execution': 0, 'code load': 1, 'data init': 2, \
+          'termination checks': 3}
+# bit lengths of comparisons and shifts per opcode name from
+# mcompile.py; the operands of these are zero unless the opcode is
+# executed, so other opcodes never feed out-of-range values
+bit_lengths = {}
 
-oram.n_threads = 1
+# threads for the internal work of the ORAMs, set when running
+n_threads = 1
+# fetch the next code entry on a separate thread while the data memory
+# is written
+overlap_fetch = False
+oram.n_threads = n_threads
+# save PC, tick and the data memory every checkpoint_interval steps to
+# Persistence/Transactions-P<party>.data for resume_code(); linear ORAMs
+# are copied directly, but other memories take an oblivious access per
+# cell, so a checkpoint costs as much as that many steps
+checkpoint_interval = None
 
 prog = program.Program.prog
 prog.set_bit_length(min(64, prog.bit_length))
@@ -14,6 +52,7 @@ prog.set_bit_length(min(64, prog.bit_length))
 arg1 = lambda in2,args: (args[1],)
 no_arg = lambda in2,args: (0,)
 deref = lambda in2,args: (in2,)
+offset = lambda in2,args: (in2 + args[1],)
 
 next = lambda PC,*args: (PC + 1,)
 
@@ -42,6 +81,7 @@ jmp = (no_arg, lambda in1,in2,args: (0, 0, 0), \
            lambda PC,in1,in2,args: args[0])
 jmp_ind = (no_arg, lambda in1,in2,args: (0, 0, 0), \
                lambda PC,in1,in2,args: in2)
+nop = (no_arg, lambda in1,in2,args: (0, 0, 0), next)
 shr1 = (no_arg, lambda in1,in2,args: (in2 >> 1, args[0], 1), next)
 shr_const = (no_arg, lambda in1,in2,args: (in2 >> args[1], args[0], 1), next)
 shr = (arg1, lambda in1,in2,args: (in2 >> in1, args[0], 1), next)
@@ -53,90 +93,1017 @@ ult_pos_const = (no_arg, lambda in1,in2,args: ((in2 < args[1]) * (in2 >= 0), arg
 ule_pos_const = (no_arg, lambda in1,in2,args: ((in2 <= args[1]) * (in2 >= 0), args[0], 1), next)
 and_ = (arg1, lambda in1,in2,args: (in1 & in2, args[0], 1), next)
 
+# fused opcodes from mcompile.py
+load_off = (offset, lambda in1,in2,args: (in1, args[0], 1), next)
+store_off = (arg1, lambda in1,in2,args: (in1, in2 + args[0], 1), next)
+store_const_off = (no_arg, lambda in1,in2,args: (args[1], in2 + args[0], 1), \
+                       next)
+br_lt = (arg1, lambda in1,in2,args: (0, 0, 0), \
+             lambda PC,in1,in2,args: if_else(in1 < in2, args[0], PC + 1))
+br_le = (arg1, lambda in1,in2,args: (0, 0, 0), \
+             lambda PC,in1,in2,args: if_else(in1 <= in2, args[0], PC + 1))
+br_eq = (arg1, lambda in1,in2,args: (0, 0, 0), \
+             lambda PC,in1,in2,args: if_else(in1 == in2, args[0], PC + 1))
+br_ne = (arg1, lambda in1,in2,args: (0, 0, 0), \
+             lambda PC,in1,in2,args: if_else(in1 != in2, args[0], PC + 1))
+br_lt_const = (no_arg, lambda in1,in2,args: (0, 0, 0), \
+                   lambda PC,in1,in2,args: \
+                   if_else(in2 < args[1], args[0], PC + 1))
+br_gt_const = (no_arg, lambda in1,in2,args: (0, 0, 0), \
+                   lambda PC,in1,in2,args: \
+                   if_else(in2 > args[1], args[0], PC + 1))
+br_le_const = (no_arg, lambda in1,in2,args: (0, 0, 0), \
+                   lambda PC,in1,in2,args: \
+                   if_else(in2 <= args[1], args[0], PC + 1))
+br_ge_const = (no_arg, lambda in1,in2,args: (0, 0, 0), \
+                   lambda PC,in1,in2,args: \
+                   if_else(in2 >= args[1], args[0], PC + 1))
+br_eq_const = (no_arg, lambda in1,in2,args: (0, 0, 0), \
+                   lambda PC,in1,in2,args: \
+                   if_else(in2 == args[1], args[0], PC + 1))
+br_ne_const = (no_arg, lambda in1,in2,args: (0, 0, 0), \
+                   lambda PC,in1,in2,args: \
+                   if_else(in2 != args[1], args[0], PC + 1))
+branches = [br_lt, br_le, br_eq, br_ne, br_lt_const, br_gt_const, \
+            br_le_const, br_ge_const, br_eq_const, br_ne_const]
+
+indirect_read = lambda op: op[0] in (deref, offset)
+indirect_write = lambda op: op in (store, store_const_ind, store_off, \
+                                   store_const_off)
+
+# primitives that the shared ALU computes at most once per step, on
+# a bit length n or the default one if None
+primitives = {
+    'lt': lambda x,y,n: x < y if n is None else x.less_than(y, n),
+    'eq': lambda x,y,n: x == y if n is None else x.equal(y, n),
+    'ltz': lambda x,y,n: x < 0 if n is None else x.less_than(0, n),
+    'mul': lambda x,y,n: x * y,
+    'shr': lambda x,y,n: x >> y if n is None else x.right_shift(y, n),
+    'shl': lambda x,y,n: x << y if n is None else x.__lshift__(y, n),
+}
+
+# shared-ALU description of opcodes: the primitives used with their
+# operand selection, and how to derive the result from the primitives
+alu_ops = {
+    mul: ((('mul', lambda in1,in2,args: (in1, in2)),), lambda r: r[0]),
+    mul_const: ((('mul', lambda in1,in2,args: (args[1], in2)),), \
+                    lambda r: r[0]),
+    lt: ((('lt', lambda in1,in2,args: (in1, in2)),), lambda r: r[0]),
+    lt_const: ((('lt', lambda in1,in2,args: (in2, args[1])),), \
+                   lambda r: r[0]),
+    gt_const: ((('lt', lambda in1,in2,args: (args[1], in2)),), \
+                   lambda r: r[0]),
+    le: ((('lt', lambda in1,in2,args: (in2, in1)),), lambda r: 1 - r[0]),
+    le_const: ((('lt', lambda in1,in2,args: (args[1], in2)),), \
+                   lambda r: 1 - r[0]),
+    ge_const: ((('lt', lambda in1,in2,args: (in2, args[1])),), \
+                   lambda r: 1 - r[0]),
+    eq: ((('eq', lambda in1,in2,args: (in1, in2)),), lambda r: r[0]),
+    eq_const: ((('eq', lambda in1,in2,args: (in2, args[1])),), \
+                   lambda r: r[0]),
+    ne: ((('eq', lambda in1,in2,args: (in1, in2)),), lambda r: 1 - r[0]),
+    ne_const: ((('eq', lambda in1,in2,args: (in2, args[1])),), \
+                   lambda r: 1 - r[0]),
+    ult_pos_const: ((('lt', lambda in1,in2,args: (in2, args[1])), \
+                     ('ltz', lambda in1,in2,args: (in2, 0))), \
+                        lambda r: r[0] * (1 - r[1])),
+    ule_pos_const: ((('lt', lambda in1,in2,args: (args[1], in2)), \
+                     ('ltz', lambda in1,in2,args: (in2, 0))), \
+                        lambda r: (1 - r[0]) * (1 - r[1])),
+    shr_const: ((('shr', lambda in1,in2,args: (in2, args[1])),), \
+                    lambda r: r[0]),
+    shr: ((('shr', lambda in1,in2,args: (in2, in1)),), lambda r: r[0]),
+    shl: ((('shl', lambda in1,in2,args: (in2, in1)),), lambda r: r[0]),
+}
+
+# fused branches take the condition from the shared ALU
+branch_conditions = {br_lt: lt, br_le: le, br_eq: eq, br_ne: ne, \
+                     br_lt_const: lt_const, br_gt_const: gt_const, \
+                     br_le_const: le_const, br_ge_const: ge_const, \
+                     br_eq_const: eq_const, br_ne_const: ne_const}
+for branch,condition in branch_conditions.items():
+    alu_ops[branch] = alu_ops[condition]
+
+# shift amounts of the right shifts
+shift_amounts = {
+    shr1: lambda in1,in2,args: 1,
+    shr_const: lambda in1,in2,args: args[1],
+    shr: lambda in1,in2,args: in1,
+}
+
+def compose(bits):
+    """ Integer from two's complement bits. """
+    return sum(bit * 2 ** i for i,bit in enumerate(bits[:-1])) - \
+        bits[-1] * 2 ** (len(bits) - 1)
+
+def shift_bits(bits, amount_bits, right):
+    """ Barrel shifter with sign extension for right shifts. """
+    for j,bit in enumerate(amount_bits):
+        n = 2 ** j
+        if right:
+            shifted = (bits[n:] + bits[-1:] * n)[:len(bits)]
+        else:
+            shifted = ([0] * n + bits)[:len(bits)]
+        bits = [x + bit * (y - x) for x,y in zip(bits, shifted)]
+    return bits
+
+def binary_postops(inst_index, operations, in1, in2, args, postops):
+    """ Compute the bitwise opcodes from one bit decomposition of
+    each operand. Right shifts select their amount first and share one
+    shifter. Only the decompositions that the opcodes of the program
+    need are computed. """
+    if not set(operations) & set([and_, shl] + list(shift_amounts)):
+        return postops
+    k = prog.bit_length
+    n = ceil_log2(k)
+    bits2 = bit_decompose(in2, k)
+    results = {}
+    if and_ in operations:
+        bits1 = bit_decompose(in1, k)
+        results[operations.index(and_)] = \
+            compose([x * y for x,y in zip(bits1, bits2)])
+    right = [(i, shift_amounts[op](in1, in2, args)) \
+                 for i,op in enumerate(operations) if op in shift_amounts]
+    if right:
+        amount = type(in2)(select(inst_index, right))
+        res = compose(shift_bits(bits2, bit_decompose(amount, n), True))
+        for i,_ in right:
+            results[i] = res
+    if shl in operations:
+        res = compose(shift_bits(bits2, bit_decompose(in1, n), False))
+        results[operations.index(shl)] = res
+    return [(lambda in1,in2,args,res=results[i]: (res, args[0], 1)) \
+                if i in results else postop \
+                for i,postop in enumerate(postops)]
+
+# costs of one step while it is compiled with telemetry
+step_costs = None
+
+def record(kind, key=None, n=1, cost=0):
+    """ Count something in the step being compiled, with its cost
+    in secure multiplications. """
+    if step_costs is None:
+        return
+    if key is None:
+        step_costs[kind] = step_costs.get(kind, 0) + n
+    else:
+        counts = step_costs.setdefault(kind, {})
+        counts[str(key)] = counts.get(str(key), 0) + n
+    step_costs['estimated multiplications'] = \
+        step_costs.get('estimated multiplications', 0) + n * cost
+
+def record_comparisons(operations, lengths):
+    # the shared ALU records its own
+    if shared_alu:
+        return
+    for op,bit_length in zip(operations, lengths):
+        bit_length = bit_length or prog.bit_length
+        if in_alu(op):
+            for prim,_ in alu_ops[op][0]:
+                if prim in ('lt', 'eq', 'ltz'):
+                    record('comparisons', bit_length, \
+                           cost=decompose_cost(bit_length))
+
+class CountedMemory(object):
+    """ Count the accesses to a memory while a step is compiled. """
+    def __init__(self, memory, name, data_type=sint):
+        self.memory = memory
+        self.name = name
+        if isinstance(memory, PublicCode):
+            self.cost = public_code_cost(2 ** memory.n_bits, \
+                                         memory.value_length, data_type)
+        else:
+            size = max(2, getattr(memory, 'size', 2))
+            value_length = getattr(memory, 'value_length', 1)
+            if isinstance(memory, LinearORAM):
+                self.cost = linear_cost(size, value_length, data_type)
+            else:
+                self.cost = tree_cost(size, value_length, data_type)
+    def __getitem__(self, index):
+        record('memory accesses', self.name + ' read', cost=self.cost)
+        return self.memory[index]
+    def __setitem__(self, index, value):
+        record('memory accesses', self.name + ' write', cost=self.cost)
+        self.memory[index] = value
+    def access(self, *args):
+        record('memory accesses', self.name + ' write', cost=self.cost)
+        return self.memory.access(*args)
+    def __getattr__(self, name):
+        return getattr(self.memory, name)
+
+def counted(data, data_type=sint, name='data'):
+    if isinstance(data, SplitMemory):
+        return SplitMemory(counted(data.arrays, data_type, 'arrays'), \
+                           counted(data.scalars, data_type, 'scalars'), \
+                           data.n_array_vars)
+    elif isinstance(data, TieredMemory):
+        return TieredMemory(counted(data.registers, data_type, 'registers'), \
+                            counted(data.memory, data_type))
+    else:
+        return CountedMemory(data, name, data_type)
+
+def bit_decompose(x, n_bits):
+    record('bit decompositions', n_bits, cost=decompose_cost(n_bits, type(x)))
+    return x.bit_decompose(n_bits)
+
 def run_inst(inst_index, instructions, *args):
+    outputs = [op(*args) for op in instructions]
+    record('opcode selection products', n=len(instructions) * len(outputs[0]), \
+           cost=1)
     return (sum(map(lambda x,y: x * x.hard_conv(y), inst_index, results)) \
-                for results in zip(*(op(*args) for op in instructions)))
+                for results in zip(*outputs))
+
+def select(inst_index, values, masked=False):
+    if len(values) == 1 and not masked:
+        return values[0][1]
+    record('opcode selection products', n=len(values), cost=1)
+    return sum(inst_index[i] * inst_index[i].hard_conv(x) for i,x in values)
+
+def in_alu(op):
+    # binary mode computes shifts from bits instead
+    return op in alu_ops and \
+        not (binary_ops and op in [shl] + list(shift_amounts))
+
+def alu_outputs(op, res):
+    """ Postop and jump of an ALU opcode from its result. """
+    if op in branch_conditions:
+        return op[1], lambda PC,in1,in2,args: if_else(res, args[0], PC + 1)
+    else:
+        return (lambda in1,in2,args: (res, args[0], 1)), op[2]
+
+def shared_postops(inst_index, operations, lengths, in1, in2, args):
+    """ Compute every primitive once on operands selected by the
+    opcode bits and derive the postops of the ALU opcodes and the jumps
+    of the fused branches from it. """
+    users = {}
+    for i,op in enumerate(operations):
+        if not in_alu(op):
+            continue
+        for prim,operands in alu_ops[op][0]:
+            users.setdefault(prim, []).append((i, operands(in1, in2, args)))
+    results = {}
+    for prim,operands in users.items():
+        known = [lengths[i] for i,_ in operands]
+        bit_length = None if None in known else max(known)
+        masked = bit_length is not None
+        x = select(inst_index, [(i, x) for i,(x,y) in operands], masked)
+        y = select(inst_index, [(i, y) for i,(x,y) in operands], masked)
+        if prim in ('lt', 'eq', 'ltz'):
+            n_bits = bit_length or prog.bit_length
+            record('comparisons', n_bits, cost=decompose_cost(n_bits))
+        results[prim] = primitives[prim](x, y, bit_length)
+    outputs = []
+    for op in operations:
+        if in_alu(op):
+            prims, derive = alu_ops[op]
+            res = derive([results[prim] for prim,_ in prims])
+            outputs.append(alu_outputs(op, res))
+        else:
+            outputs.append(op[1:])
+    return list(zip(*outputs))
+
+def narrow_postops(inst_index, operations, lengths, in1, in2, args):
+    """ Postops and jumps with the comparisons and shifts of every ALU
+    opcode with a known bit length on that length. Its operands are
+    multiplied by its opcode bit to keep them in range. """
+    outputs = []
+    for i,(op,bit_length) in enumerate(zip(operations, lengths)):
+        if bit_length is None or not in_alu(op):
+            outputs.append(op[1:])
+            continue
+        prims, derive = alu_ops[op]
+        bit = inst_index[i]
+        res = derive([primitives[prim](*([bit * x for x in \
+                                              operands(in1, in2, args)] + \
+                                             [bit_length])) \
+                      for prim,operands in prims])
+        outputs.append(alu_outputs(op, res))
+    return list(zip(*outputs))
 
 def run(code, data, operations, start=0, data_type=sint):
-    preops, postops, jumps = list(zip(*operations))
-    PC = MemValue(data_type(start))
-    tick = MemValue(cint(0))
-    @do_while
-    def f():
-        if do_tick:
-            @if_(tick % 10 == 0)
+    run_batch([code], [data], operations, [start], data_type)
+
+def memory_leaves(data):
+    """ The ORAMs holding the cells of a data memory. """
+    if isinstance(data, SplitMemory):
+        return memory_leaves(data.arrays) + memory_leaves(data.scalars)
+    elif isinstance(data, TieredMemory):
+        return memory_leaves(data.registers) + memory_leaves(data.memory)
+    else:
+        return [data]
+
+def storage(memory):
+    """ The arrays behind a linear ORAM (empty flags, indices and
+    values), which hold its whole state, or None for other memories. """
+    if isinstance(memory, TrivialORAM):
+        return memory.ram.l
+
+def checkpoint_size(memory):
+    arrays = storage(memory)
+    if arrays is None:
+        return memory.size
+    return sum(len(array) for array in arrays)
+
+class Checkpoints(object):
+    """ Machine state in the persistence file: per instance two slots
+    of tick, PC and the memory cells, written alternately. A slot is
+    marked invalid with tick 0 before it is overwritten and gets its
+    tick last, so an interrupted write leaves the other slot to resume
+    from. The storage of linear ORAMs is copied with one vectorized
+    write or read per array. Other memories take an oblivious access
+    per cell. """
+    def __init__(self, datas, data_type=sint):
+        self.value_type = data_type.basic_type
+        if not hasattr(self.value_type, 'write_to_file'):
+            raise Exception('checkpoints are not supported for %s' % \
+                            self.value_type.__name__)
+        self.datas = datas
+        self.data_type = data_type
+        self.slot_sizes = [2 + sum(checkpoint_size(memory) \
+                                       for memory in memory_leaves(data)) \
+                               for data in datas]
+        self.bases = [2 * sum(self.slot_sizes[:i]) for i in range(len(datas))]
+    def write(self, value, position):
+        self.value_type.write_to_file([self.value_type(value)], position)
+    def read(self, position):
+        return self.value_type.read_from_file(position, 1)[1][0]
+    def save(self, tick, PCs, slot):
+        for base,size,data,PC in zip(self.bases, self.slot_sizes, \
+                                     self.datas, PCs):
+            position = regint(base + slot * size)
+            self.write(0, position)
+            self.write(PC.read(), position + 1)
+            offset = 2
+            for memory in memory_leaves(data):
+                arrays = storage(memory)
+                if arrays is None:
+                    @for_range(memory.size)
+                    def f(i):
+                        self.write(memory[i], position + offset + i)
+                    offset += memory.size
+                    continue
+                for array in arrays:
+                    array.value_type.write_to_file(array.get_vector(), \
+                                                   position + offset)
+                    offset += len(array)
+            self.write(tick.read(), position)
+    def restore(self, tick, PCs):
+        for base,size,data,PC in zip(self.bases, self.slot_sizes, \
+                                     self.datas, PCs):
+            ticks = [self.read(regint(base + slot * size)).reveal() \
+                         for slot in (0, 1)]
+            slot = ticks[1] > ticks[0]
+            last = ticks[0] + slot * (ticks[1] - ticks[0])
+            @if_(last == 0)
             def f():
-                tick.read().print_reg('tick')
-                time()
-            tick.iadd(1)
-        args = list(code[PC])
+                print_ln('no checkpoint to resume from')
+                crash()
+            position = regint(base + slot * size)
+            PC.write(self.data_type(self.read(position + 1)))
+            offset = 2
+            for memory in memory_leaves(data):
+                arrays = storage(memory)
+                if arrays is None:
+                    @for_range(memory.size)
+                    def f(i):
+                        memory[i] = self.read(position + offset + i)
+                    offset += memory.size
+                    continue
+                for array in arrays:
+                    array.assign(array.value_type.read_from_file( \
+                        position + offset, len(array))[1])
+                    offset += len(array)
+            tick.write(last)
+        print_ln('Resuming after %s steps', tick)
+
+def run_batch(codes, datas, operations, starts, data_type=sint, \
+              resume=False, lengths=None):
+    """ Run independent instances in lockstep. The steps of all instances
+    are in the same loop body, so they share communication rounds, and
+    instances that have halted continue with no-op steps. Returns
+    not_done with max_steps and None otherwise. The bit lengths of the
+    comparisons and shifts of the operations are in lengths, with None
+    for the default. """
+    global step_costs, not_done
+    not_done = None
+    preops = [op[0] for op in operations]
+    lengths = lengths or [None] * len(operations)
+    if checkpoint_interval or resume:
+        checkpoints = Checkpoints(datas, data_type)
+    if telemetry:
+        codes = [CountedMemory(code, 'code', data_type) for code in codes]
+        datas = [counted(data, data_type) for data in datas]
+    oram.n_threads = n_threads
+    PCs = [MemValue(data_type(start)) for start in starts]
+    tick = MemValue(cint(0))
+    if resume:
+        checkpoints.restore(tick, PCs)
+    if overlap_fetch:
+        # the first entries from the restored PCs when resuming, of the
+        # type of the code memory
+        buffers = []
+        for code,PC in zip(codes, PCs):
+            entry = list(code[PC])
+            buffers.append(Array(len(entry), code.value_type))
+            for i,x in enumerate(entry):
+                buffers[-1][i] = x
+    blind = check_interval > 1 or max_steps is not None or len(codes) > 1
+    def execute(inst, data):
+        """ Read the operands and compute the result of one instruction
+        without writing it. """
+        args = list(inst)
         op = args.pop(0)
-        op_index = op.bit_decompose(len(operations))
-        in2 = data_type(data[args[2]])
-        args = [data_type(arg) for arg in args]
-        p_in1, = run_inst(op_index, preops, in2, args)
-        in1 = data_type(data[p_in1])
-        op_res, p_out, write = run_inst(op_index, postops, in1, in2, args)
-        data.access(p_out, op_res, write)
-        jump, = run_inst(op_index, jumps, PC, in1, in2, args)
-        PC.write(data_type(jump))
-        not_done = (sum(op_index)).reveal()
+        tiered = isinstance(data, TieredMemory)
+        split = isinstance(data, SplitMemory)
+        out_mem = None
+        if tiered:
+            bits = bit_decompose(op, len(operations) + 3)
+            op_index = bits[:len(operations)]
+            in2_mem, in1_mem, out_mem = bits[len(operations):]
+            args = [data_type(arg) for arg in args]
+            in1, in2 = read_tiered(data, op_index, operations, args, \
+                                   in2_mem, in1_mem)
+            in1, in2 = data_type(in1), data_type(in2)
+            p_in1 = args[1]
+        else:
+            op_index = bit_decompose(op, len(operations))
+            if split:
+                in2 = data_type(data.scalars[args[2] - data.n_array_vars])
+            else:
+                in2 = data_type(data[args[2]])
+            args = [data_type(arg) for arg in args]
+            p_in1, = run_inst(op_index, preops, in2, args)
+            if split:
+                in1 = data_type(data.read(op_index, operations, p_in1))
+            else:
+                in1 = data_type(data[p_in1])
+        if shared_alu:
+            step_postops, step_jumps = \
+                shared_postops(op_index, operations, lengths, in1, in2, args)
+        else:
+            step_postops, step_jumps = \
+                narrow_postops(op_index, operations, lengths, in1, in2, args)
+        record_comparisons(operations, lengths)
+        if binary_ops:
+            step_postops = binary_postops(op_index, operations, in1, in2, \
+                                          args, step_postops)
+        op_res, p_out, write = run_inst(op_index, step_postops, in1, in2, args)
         if debug:
             print_ln('op: %s, args: %s, %s, %s', op.reveal(), \
                          *(x.reveal() for x in args))
             print_ln('p_in1: %s, in1: %s, in2: %s, op_res: %s', \
                          p_in1.reveal(), in1.reveal(), in2.reveal(), \
                          op_res.reveal())
+        return op_index, args, in1, in2, step_jumps, op_res, p_out, write, \
+            out_mem
+    def fetch_tape(code, PC, buffer):
+        def fetch(arg):
+            # a tape cannot start further threads
+            oram.n_threads = 1
+            for i,x in enumerate(code[PC]):
+                buffer[i] = x
+            oram.n_threads = n_threads
+        return prog.new_tape(fetch, (0,), 'fetch')
+    def step(code, data, PC, fetcher=None):
+        # a code entry holds one instruction or a bundle of independent
+        # instructions from mcompile.py -W, which read before any writes
+        if fetcher:
+            buffer, tape = fetcher
+            entry = [buffer[i] for i in range(len(buffer))]
+        else:
+            entry = list(code[PC])
+        insts = [execute(entry[i:i + 4], data) \
+                     for i in range(0, len(entry), 4)]
+        # control flow is in the last instruction of a bundle
+        op_index, args, in1, in2, step_jumps = insts[-1][:5]
+        jump, = run_inst(op_index, step_jumps, PC, in1, in2, args)
+        running = sum(op_index)
+        if blind:
+            # halting keeps PC so that further steps are no-ops
+            jump = jump + (1 - running) * PC.read()
+        PC.write(data_type(jump))
+        if fetcher:
+            thread = prog.run_tape(tape, 0)
+        for op_index, args, in1, in2, _, op_res, p_out, write, out_mem \
+                in insts:
+            if out_mem is not None:
+                write_tiered(data, op_index, operations, args, out_mem, \
+                             p_out, op_res, write)
+            elif isinstance(data, SplitMemory):
+                data.write(op_index, operations, p_out, op_res, write)
+            else:
+                data.access(p_out, op_res, write)
+        if fetcher:
+            prog.join_tape(thread)
+        if debug:
             print_ln('write: %s, jump: %s, PC: %s, done: %s', \
                          write.reveal(), jump.reveal(), PC.reveal(), \
-                         (1 - not_done))
-        return regint(not_done)
+                         (1 - running).reveal())
+        return running
+    def step_all():
+        if do_tick and not telemetry:
+            @if_(tick % 10 == 0)
+            def f():
+                tick.read().print_reg('tick')
+                time()
+        if do_tick or telemetry or checkpoint_interval:
+            tick.iadd(1)
+        res = sum(step(*x) for x in zip(codes, datas, PCs, fetchers))
+        if checkpoint_interval:
+            @if_(tick % checkpoint_interval == 0)
+            def f():
+                checkpoints.save(tick, PCs, \
+                                 tick % (2 * checkpoint_interval) != 0)
+        return res
+    def check(running):
+        if telemetry:
+            start_timer(phases['termination checks'])
+        res = regint(running.reveal() != 0)
+        if telemetry:
+            stop_timer(phases['termination checks'])
+        return res
+    if telemetry:
+        step_costs = {}
+    if overlap_fetch:
+        fetchers = [(buffer, fetch_tape(code, PC, buffer)) \
+                        for code,PC,buffer in zip(codes, PCs, buffers)]
+    else:
+        fetchers = [None] * len(codes)
+    if max_steps is not None:
+        running = MemValue(data_type(0))
+        @for_range(max_steps - regint(tick.read()) if resume else max_steps)
+        def f(i):
+            running.write(step_all())
+        not_done = running.read()
+    elif blind:
+        @do_while
+        def f():
+            running = MemValue(data_type(0))
+            @for_range(check_interval)
+            def f(i):
+                running.write(step_all())
+            return check(running.read())
+    else:
+        @do_while
+        def f():
+            return check(step_all())
     print_ln('Ticks: %s', tick)
+    if telemetry:
+        # the timers and ticks are in the MP-SPDZ output
+        report = {'timers': phases, 'instances': len(codes), \
+                  'operations': len(operations), 'per step': step_costs}
+        step_costs = None
+        with open(telemetry, 'w') as out:
+            json.dump(report, out, indent=1, sort_keys=True)
+    return not_done
+
+def select_bits(inst_index, operations, condition):
+    return sum(bit for bit,op in zip(inst_index, operations) if condition(op))
 
-def run_code_with_data(code, data, start=0, data_type=sint, oram_type=OptimalORAM):
+class SplitMemory(object):
+    """ Data memory laid out by mcompile.py -R: cells that pointers
+    can refer to are in an array memory, and all other cells are in a
+    scalar memory after it. Direct operands only refer to scalars, so
+    every step reads and writes the array memory at most once. """
+    def __init__(self, arrays, scalars, n_array_vars):
+        self.arrays = arrays
+        self.scalars = scalars
+        self.n_array_vars = n_array_vars
+    def __getitem__(self, index):
+        if index < self.n_array_vars:
+            return self.arrays[index]
+        else:
+            return self.scalars[index - self.n_array_vars]
+    def __setitem__(self, index, value):
+        if isinstance(index, int):
+            if index < self.n_array_vars:
+                self.arrays[index] = value
+            else:
+                self.scalars[index - self.n_array_vars] = value
+        else:
+            @if_e(index < self.n_array_vars)
+            def f():
+                self.arrays[index] = value
+            @else_
+            def f():
+                self.scalars[index - self.n_array_vars] = value
+    def read(self, op_index, operations, p_in1):
+        direct = select_bits(op_index, operations, lambda op: op[0] is arg1)
+        indirect = select_bits(op_index, operations, indirect_read)
+        return read_memory(self, direct, p_in1, indirect, p_in1)
+    def write(self, op_index, operations, p_out, value, write):
+        indirect = select_bits(op_index, operations, indirect_write)
+        write_memory(self, write - indirect, p_out, indirect, p_out, value)
+
+class TieredMemory(object):
+    """ Register file for temporaries in front of the data memory, as
+    laid out by mcompile.py -T. """
+    def __init__(self, registers, memory):
+        self.registers = registers
+        self.memory = memory
+    def __getitem__(self, index):
+        return self.memory[index]
+    def __setitem__(self, index, value):
+        self.memory[index] = value
+
+def read_tiered(data, op_index, operations, args, in2_mem, in1_mem):
+    """ Read the operands from the register file or the data memory.
+    The compiler ensures that at most one operand per step is in memory,
+    and that pointers for loads are in registers. """
+    registers = data.registers
+    in2_reg = registers[(1 - in2_mem) * args[2]]
+    direct = select_bits(op_index, operations, lambda op: op[0] is arg1)
+    indirect = select_bits(op_index, operations, indirect_read)
+    shift = select_bits(op_index, operations, lambda op: op[0] is offset)
+    in1_reg = registers[(direct - in1_mem) * args[1]]
+    value = read_memory(data.memory, in2_mem + in1_mem, \
+                        in2_mem * args[2] + in1_mem * args[1], \
+                        indirect, in2_reg + shift * args[1])
+    in2 = in2_reg + in2_mem * (value - in2_reg)
+    in1 = in1_reg + (in1_mem + indirect) * (value - in1_reg)
+    return in1, in2
+
+def write_tiered(data, op_index, operations, args, out_mem, p_out, value, \
+                 write):
+    indirect = select_bits(op_index, operations, indirect_write)
+    direct = write - indirect - out_mem
+    data.registers.access(direct * args[0], value, direct)
+    write_memory(data.memory, out_mem, args[0], indirect, p_out, value)
+
+def read_memory(data, direct, direct_address, indirect, indirect_address):
+    """ Read at a direct or an indirect address, selected by bits of
+    which at most one is set. """
+    if isinstance(data, SplitMemory):
+        res = direct * data.scalars[direct * \
+                                    (direct_address - data.n_array_vars)]
+        if not isinstance(indirect, int):
+            res += indirect * data.arrays[indirect * indirect_address]
+        return res
+    else:
+        return data[direct * direct_address + indirect * indirect_address]
+
+def write_memory(data, direct, direct_address, indirect, indirect_address, \
+                 value):
+    if isinstance(data, SplitMemory):
+        if not isinstance(indirect, int):
+            data.arrays.access(indirect * indirect_address, value, indirect)
+        data.scalars.access(direct * (direct_address - data.n_array_vars), \
+                            value, direct)
+    else:
+        data.access(direct * direct_address + indirect * indirect_address, \
+                    value, direct + indirect)
+
+def load_inputs(contents, inputs, value_type):
+    """ Fill the secret input regions (address, length, party) from
+    mcompile.py in the memory image with one vectorized input per party
+    and a vectorized copy per region. """
+    for party in sorted(set(party for _,_,party in inputs)):
+        regions = [(address, length) for address,length,p in inputs \
+                       if p == party]
+        total = sum(length for _,length in regions)
+        values = Array(total, value_type)
+        values.assign(value_type.get_input_from(party, size=total))
+        offset = 0
+        for address,length in regions:
+            contents.assign(values.get_vector(offset, length), address)
+            offset += length
+
+def memory_cells(data):
+    """ Number of addresses of a data memory. """
+    if isinstance(data, SplitMemory):
+        return data.n_array_vars + data.scalars.size
+    elif isinstance(data, TieredMemory):
+        return memory_cells(data.memory)
+    else:
+        return data.size
+
+def batch_load_data(data, contents):
+    """ Fill the ORAMs of a data memory from one array of its cells. """
+    if isinstance(data, SplitMemory):
+        n = data.n_array_vars
+        if n:
+            batch_load(data.arrays, contents.get_part(0, n))
+        batch_load(data.scalars, contents.get_part(n, len(contents) - n))
+    elif isinstance(data, TieredMemory):
+        batch_load_data(data.memory, contents)
+    else:
+        batch_load(data, contents)
+
+def load_data(data, initial_data, n_placeholders=0, inputs=[], \
+              value_type=sint, global_cells=None):
+    """ Write the memory image: the initial data, the secret input,
+    and the placeholder input 32 + i % 96 in the other cells below
+    n_placeholders, so that every cell is written once. With
+    global_cells from mcompile.py -R, the placeholder for cell i goes
+    to global_cells[i] instead. The image is assembled in an array and
+    then goes to the memory with batch_load(). """
+    if global_cells is not None:
+        input_cells = set(address + i for address,length,_ in inputs \
+                              for i in range(length))
+        placeholders = dict((x, 32 + i % 96) \
+                            for i,x in enumerate(global_cells) \
+                            if x not in input_cells)
+        placeholders.update(initial_data)
+        initial_data = placeholders
+        n_placeholders = 0
+    filled = sorted([(address, address + 1) for address in initial_data] + \
+                    [(address, address + length) \
+                         for address,length,_ in inputs])
+    gaps = []
+    start = 0
+    for address,stop in filled + [(n_placeholders, n_placeholders)]:
+        if start < min(address, n_placeholders):
+            gaps.append((start, min(address, n_placeholders)))
+        start = max(start, stop)
+    contents = Array(memory_cells(data), value_type)
+    contents.assign_all(0)
+    for start,stop in gaps:
+        @for_range(start, stop)
+        def f(i):
+            contents[i] = 32 + i % 96
+    load_inputs(contents, inputs, value_type)
+    if initial_data:
+        addresses = Array(len(initial_data), regint)
+        values = Array(len(initial_data), regint)
+        for i,(address,value) in enumerate(sorted(initial_data.items())):
+            addresses[i] = address
+            values[i] = value
+        @for_range(len(initial_data))
+        def f(i):
+            contents[addresses[i]] = values[i]
+    batch_load_data(data, contents)
+
+def get_operations(code):
+    """ Opcodes used in the code, their names, and the code with the
+    opcodes as bits. """
+    if isinstance(code, CodeImage):
+        operations = [globals()[name] for name in code.names]
+        n_fields = len(code.formats)
+        res = []
+        for values in code.entries():
+            entry = []
+            for i in range(0, len(values), n_fields):
+                inst = values[i:i + n_fields]
+                tiers = inst[4] if n_fields > 4 else 0
+                entry.append((1 << inst[0]) + (tiers << len(operations)))
+                entry.extend(inst[1:4])
+            res.append(entry)
+        res.append([0] * len(res[0]))
+        return operations, code.names, res
+    if not isinstance(code[0][0], str):
+        # bundles from mcompile.py -W become one code entry each
+        operations, names, flat = \
+            get_operations(sum((list(bundle) for bundle in code), []))
+        width = len(code[0])
+        code = [sum(flat[i:i + width], []) \
+                    for i in range(0, len(flat) - 1, width)]
+        code.append([0] * len(code[0]))
+        return operations, names, code
     operations = []
-    code_oram = oram_type(len(code) + 1, value_length=4, \
-                                value_type=data_type.basic_type, \
-                                init_rounds=0)
+    names = []
     code = list(list(inst) for inst in code)
-    for i,inst in enumerate(code):
-        try:
-            op = operations.index(globals()[inst[0]])
-        except ValueError:
-            op = len(operations)
+    for inst in code:
+        if globals()[inst[0]] not in operations:
             if debug:
-                print(op, inst[0])
+                print(len(operations), inst[0])
             operations.append(globals()[inst[0]])
-        inst[0] = 1 << op
+            names.append(inst[0])
+    for inst in code:
+        op = operations.index(globals()[inst[0]])
+        # operand tiers from mcompile.py -T go above the opcode bits
+        tiers = inst.pop(4) if len(inst) > 4 else 0
+        inst[0] = (1 << op) + (tiers << len(operations))
     code.append((0, 0, 0, 0))
+    return operations, names, code
+
+def demux(bits):
+    res = [1]
+    for bit in bits:
+        tmp = [x * bit for x in res]
+        res = [x - y for x,y in zip(res, tmp)] + tmp
+    return res
+
+class PublicCode(object):
+    """ Read-only memory with public contents, built directly from
+    the instruction list without any oblivious writes. The entries are
+    arranged in a square, and an access selects a column by combining
+    every row with public coefficients and then a row obliviously,
+    which costs about twice the square root of the size in secure
+    multiplications. """
+    def __init__(self, code, data_type=sint):
+        self.data_type = data_type
+        self.value_type = data_type
+        self.n_bits = ceil_log2(len(code))
+        self.n_col_bits = (self.n_bits + 1) // 2
+        n_cols = 2 ** self.n_col_bits
+        self.rows = [code[i:i+n_cols] for i in range(0, len(code), n_cols)]
+        self.value_length = len(code[0])
+    def __getitem__(self, index):
+        if isinstance(index, MemValue):
+            index = index.read()
+        bits = self.data_type(index).bit_decompose(self.n_bits)
+        cols = demux(bits[:self.n_col_bits])
+        rows = demux(bits[self.n_col_bits:])
+        res = []
+        for i in range(self.value_length):
+            res.append(sum(row_bit * sum(col_bit * int(inst[i]) \
+                                         for col_bit,inst in zip(cols, row) \
+                                         if inst[i] != 0) \
+                           for row_bit,row in zip(rows, self.rows)))
+        return [self.data_type(x) for x in res]
+
+def ceil_log2(x):
+    return max(1, int(math.ceil(math.log(x, 2))))
+
+def decompose_cost(n_bits, data_type=sint):
+    if getattr(data_type, 'basic_type', data_type) is sgf2n:
+        return n_bits
+    else:
+        return prog.bit_length + n_bits
+
+def linear_cost(size, value_length=1, data_type=sint):
+    return decompose_cost(ceil_log2(size), data_type) + size * (value_length + 2)
+
+def tree_cost(size, value_length=1, data_type=sint, pack=8, \
+              threshold=2**10, bucket_size=4):
+    res = 0
+    while size > threshold:
+        path = bucket_size * (ceil_log2(size) + 1)
+        res += 2 * path * (value_length + ceil_log2(size)) + \
+               decompose_cost(ceil_log2(size), data_type)
+        size = int(math.ceil(size / pack))
+        value_length = 1
+    return res + linear_cost(size, value_length, data_type)
+
+def public_code_cost(size, value_length=4, data_type=sint):
+    # local operations with the public entries counted as a hundredth
+    return decompose_cost(ceil_log2(size), data_type) + \
+        2 ** ((ceil_log2(size) + 1) // 2) * (value_length + 2) + \
+        size * value_length // 100
+
+def memory_costs(size, value_length=1, data_type=sint, code=False):
+    """ Rough number of secure multiplications per access for each
+    memory type. """
+    res = {
+        LinearORAM: linear_cost(size, value_length, data_type),
+        OptimalORAM: tree_cost(size, value_length, data_type),
+        AtLeastOneRecursionPackedPathORAM: \
+            tree_cost(size, value_length, data_type, \
+                      pack=max(8, prog.bit_length // ceil_log2(size)), \
+                      threshold=min(2**10, size - 1)),
+    }
+    if code:
+        res[PublicCode] = public_code_cost(size, value_length, data_type)
+    return res
+
+def choose_memory(size, value_length=1, data_type=sint, code=False):
+    costs = memory_costs(size, value_length, data_type, code)
+    res = min(costs, key=costs.get)
+    print('%s memory of size %d: %s, about %d multiplications per access' % \
+          ('code' if code else 'data', size, res.__name__, costs[res]))
+    return res
+
+def AutoORAM(size, value_type=sint, value_length=1, **kwargs):
+    """ Data memory of the type with the lowest predicted cost. """
+    oram_type = choose_memory(size, value_length, value_type)
+    return oram_type(size, value_type=value_type, value_length=value_length, \
+                     **kwargs)
+
+class CodeImage(object):
+    """ Code from an image, left packed until get_operations() decodes
+    it into the code memory entries. """
+    def __init__(self, names, width, formats, data):
+        self.names = names
+        self.width = width
+        self.formats = formats
+        self.data = data
+    def entries(self):
+        """ Fields of all instructions of each entry. """
+        return struct.iter_unpack('<' + self.formats * self.width, self.data)
+
+def load_image(filename):
+    """ Read a code image written by mcompile.py -B. Returns start,
+    check, n_vars, n_global_vars and the code as CodeImage. """
+    with open(filename, 'rb') as f:
+        image = f.read()
+    if image[:4] != b'C2MI':
+        raise Exception('not a code image: %s' % filename)
+    start, check, n_vars, n_global_vars, n_entries, width, fields, \
+        names_length = struct.unpack_from('<8q', image, 4)
+    formats = image[68:68 + fields].decode('ascii')
+    names = image[68 + fields:68 + fields + names_length].decode('ascii')
+    code = CodeImage(names.split('\n'), width, formats, \
+                     image[68 + fields + names_length:])
+    return start, check, n_vars, n_global_vars, code
+
+def batch_load(memory, entries, value_type=None):
+    """ Fill a fresh memory with all entries at once instead of an
+    oblivious write per entry. Linear ORAMs store them directly, and
+    tree ORAMs use their batch initialization, which MP-SPDZ offers for
+    sint if the size is a power of two. Other memories still take a
+    write per entry, with the values of a list converted to value_type. """
+    size = memory.size
+    if isinstance(memory, TrivialORAM) or \
+       hasattr(memory, 'batch_init') and memory.value_type is sint and \
+       len(entries) == size and not size & (size - 1):
+        memory.batch_init(entries)
+    elif isinstance(entries, Array):
+        @for_range(len(entries))
+        def f(i):
+            memory[i] = entries[i]
+    else:
+        @foreach_enumerate(entries)
+        def f(i, *entry):
+            @if_(i % 1000 == 0)
+            def f():
+                print_ln('Loaded %s/%s entries', i, len(entries))
+                time()
+            memory[i] = [(value_type or memory.value_type)(x) \
+                         for x in entry]
+
+def load_code(code, data_type=sint, oram_type=OptimalORAM):
+    if oram_type is AutoORAM:
+        oram_type = choose_memory(len(code), len(code[0]), data_type, True)
+    if public_code or oram_type is PublicCode:
+        return PublicCode(code, data_type)
+    code_oram = oram_type(len(code), value_length=len(code[0]), \
+                                value_type=data_type.basic_type, \
+                                init_rounds=0)
+    batch_load(code_oram, code, data_type)
+    return code_oram
+
+def run_code_with_data(code, data, start=0, data_type=sint, \
+                       oram_type=OptimalORAM, initial_data={}, \
+                       initial_registers={}, n_placeholders=0, inputs=[], \
+                       resume=False, global_cells=None):
+    return run_code_with_batch(code, [data], start, data_type, oram_type, \
+                               initial_data, initial_registers, \
+                               n_placeholders, inputs, resume, global_cells)
+
+def run_code_with_batch(code, datas, start=0, data_type=sint, \
+                        oram_type=OptimalORAM, initial_data={}, \
+                        initial_registers={}, n_placeholders=0, inputs=[], \
+                        resume=False, global_cells=None):
+    """ Run one program on several independent data memories, or
+    continue from the last checkpoint if resume is set. """
+    oram.n_threads = n_threads
+    operations, names, code = get_operations(code)
+    # comparisons and shifts of other types take their own bit length
+    lengths = [min(bit_lengths[name], prog.bit_length) \
+                   if name in bit_lengths and data_type is sint else None \
+                   for name in names]
+    if isinstance(datas[0], SplitMemory):
+        code[-1] = (0, 0, 0, datas[0].n_array_vars) * (len(code[0]) // 4)
     stop_timer(0)
     start_timer(1)
-    @foreach_enumerate(code)
-    def f(i, *inst):
-        @if_(i % 1000 == 0)
-        def f():
-            print_ln('Loaded %s/%s instructions', i, len(code))
-            time()
-        code_oram[i] = [data_type(x) for x in inst]
+    # one code memory read by all instances
+    code_oram = load_code(code, data_type, oram_type)
     stop_timer(1)
-    start_timer(0)
-    run(code_oram, data, operations, start, data_type)
-
-def run_code(code, data_length, start=0, n_global_vars=0, data_type=sint, \
-             oram_type=OptimalORAM):
-    data = oram_type(data_length, value_type=data_type.basic_type, \
-                     init_rounds=0)
-    stop_timer(0)
     start_timer(2)
-    @for_range(n_global_vars)
-    def f(i):
-        data[i] = 32 + i % 96
-    data[data_length-1] = 0
+    # resuming restores the data memory in run_batch()
+    for data in [] if resume else datas:
+        load_data(data, initial_data, n_placeholders, inputs, \
+                  data_type.basic_type, global_cells)
+        if isinstance(data, TieredMemory):
+            load_data(data.registers, initial_registers)
     stop_timer(2)
     start_timer(0)
-    run_code_with_data(code, data, start, data_type)
+    return run_batch([code_oram] * len(datas), datas, operations, \
+                     [start] * len(datas), data_type, resume, lengths)
+
+def run_code(code, data_length, start=0, n_global_vars=0, data_type=sint, \
+             oram_type=OptimalORAM, initial_data={}, n_array_vars=None, \
+             n_registers=None, initial_registers={}, inputs=[], \
+             resume=False, global_cells=None):
+    oram.n_threads = n_threads
+    if n_array_vars is None:
+        data = oram_type(data_length, value_type=data_type.basic_type, \
+                         init_rounds=0)
+    else:
+        scalar_type = AutoORAM if oram_type is AutoORAM else LinearORAM
+        data = SplitMemory(oram_type(max(1, n_array_vars), \
+                                     value_type=data_type.basic_type, \
+                                     init_rounds=0), \
+                           scalar_type(data_length - n_array_vars, \
+                                       value_type=data_type.basic_type, \
+                                       init_rounds=0), n_array_vars)
+    if n_registers is not None:
+        data = TieredMemory(LinearORAM(n_registers, \
+                                       value_type=data_type.basic_type, \
+                                       init_rounds=0), data)
+    initial_data = dict(initial_data)
+    initial_data.setdefault(data_length - 1, 0)
+    run_code_with_data(code, data, start, data_type, oram_type, \
+                       initial_data, initial_registers, n_global_vars, inputs, \
+                       resume, global_cells)
     return data
 
+def resume_code(*args, **kwargs):
+    """ Like run_code() but with the data memory, PC and tick from the
+    last checkpoint of a run with checkpoint_interval set. The code
+    memory is public and rebuilt. """
+    return run_code(*args, resume=True, **kwargs)
+
 def test_straight_machine():
     code = OptimalORAM(10, value_length=4)
     data = OptimalORAM(10)
@@ -1,12 +1,33 @@
 #!/usr/bin/python3
 
 import sys
-from llvm.core import *
-import llvm
+import bisect
+import struct
 from getopt import getopt
 
+if any(arg.endswith('.ll') for arg in sys.argv[1:]):
+    # textual IR from a recent clang, read without llvmpy
+    from llvmtext import *
+else:
+    from llvm.core import *
+
 debug = False
+# statistics of the passes on stderr
+verbose = False
 asm_output = False
+reuse_slots = True
+evaluate_prefix = False
+max_prefix_steps = 10 ** 7
+profile = False
+max_profile_steps = 10 ** 8
+split_memory = False
+# peephole and dead-code optimization
+optimize = False
+# superinstructions for frequent pairs of instructions
+fusion = False
+n_registers = None
+bundle_width = None
+image_file = None
 
 def get_array_type(t):
     size = 1
@@ -28,6 +49,49 @@ def get_size(t):
     else:
         raise Exception('type not implemented: %s' % t)
 
+def get_source_type(gep):
+    """ Type indexed by a getelementptr, which is explicit in
+    textual IR with opaque pointers. """
+    if hasattr(gep, 'source_type'):
+        return gep.source_type
+    return gep.operands[0].type.pointee
+
+def parse_data_array(text):
+    """ Elements of a ConstantDataArray without element operands,
+    as under llvmpy, from its textual form: [n x iK] [iK 1, iK 2, ...]
+    or [n x i8] c"...". Such an array is always flat, nested
+    aggregates are walked by get_initializer(). """
+    text = text.split(']', 1)[1].strip()
+    if text.startswith('c"'):
+        body = text[2:-1]
+        res = []
+        i = 0
+        while i < len(body):
+            if body[i] == '\\':
+                x = int(body[i + 1:i + 3], 16)
+                i += 3
+            else:
+                x = ord(body[i])
+                i += 1
+            res.append(x - 256 if x > 127 else x)
+        return res
+    return [int(x.split()[1]) for x in text.strip('[]').split(',')]
+
+def get_initializer(init):
+    """ Cell values of a global initializer, walking the operands of
+    aggregates. """
+    if isinstance(init, ConstantInt):
+        return [init.s_ext_value]
+    elif isinstance(init, ConstantAggregateZero):
+        return [0] * get_size(init.type)[0]
+    elif isinstance(init, (ConstantDataArray, ConstantArray, \
+                           ConstantStruct)) and init.operands:
+        return sum((get_initializer(x) for x in init.operands), [])
+    elif isinstance(init, ConstantDataArray):
+        return parse_data_array(str(init))
+    else:
+        raise Exception('not implemented: unknown initialization')
+
 class Value(int):
     __str__ = lambda self: '*' * self.depth + str(int(self)) + \
         ('d' if self.direct else '')
@@ -44,6 +108,10 @@ class Value(int):
         scope.vars[inst] = res
         return res
 
+class Label(int):
+    """ Code address stored in data memory. """
+    pass
+
 def Constant(x):
     res = Value(x)
     res.depth = 0
@@ -63,6 +131,286 @@ def get_value(value, t, size=1, start_depth=0):
         t = t.pointee
     return res
 
+# memory operands of each opcode: positions read as addresses and
+# position written as address (None for no or indirect write)
+memory_operands = {
+    'add': ((2, 3), 1),
+    'mul': ((2, 3), 1),
+    'lt': ((2, 3), 1),
+    'br': ((3,), None),
+    'mov': ((2,), 1),
+    'load': ((3,), 1),
+    'store': ((2, 3), None),
+    'store_const': ((), 1),
+    'store_const_ind': ((3,), None),
+    'add_const': ((3,), 1),
+    'mul_const': ((3,), 1),
+    'lt_const': ((3,), 1),
+    'gt_const': ((3,), 1),
+    'eq': ((2, 3), 1),
+    'eq_const': ((3,), 1),
+    'le': ((2, 3), 1),
+    'le_const': ((3,), 1),
+    'ge_const': ((3,), 1),
+    'ne': ((2, 3), 1),
+    'ne_const': ((3,), 1),
+    'jmp': ((), None),
+    'jmp_ind': ((3,), None),
+    'shr1': ((3,), 1),
+    'shr_const': ((3,), 1),
+    'shr': ((2, 3), 1),
+    'shl': ((2, 3), 1),
+    'rsub_const': ((3,), 1),
+    'sub_const': ((3,), 1),
+    'sub': ((2, 3), 1),
+    'ult_pos_const': ((3,), 1),
+    'ule_pos_const': ((3,), 1),
+    'and_': ((2, 3), 1),
+    'nop': ((), None),
+    'load_off': ((3,), 1),
+    'store_off': ((2, 3), None),
+    'store_const_off': ((3,), None),
+    'br_lt': ((2, 3), None),
+    'br_le': ((2, 3), None),
+    'br_eq': ((2, 3), None),
+    'br_ne': ((2, 3), None),
+    'br_lt_const': ((3,), None),
+    'br_gt_const': ((3,), None),
+    'br_le_const': ((3,), None),
+    'br_ge_const': ((3,), None),
+    'br_eq_const': ((3,), None),
+    'br_ne_const': ((3,), None),
+}
+
+# comparisons that can be fused with a branch, and their negation
+# with swapped operands if necessary
+negations = {
+    'lt': ('le', True),
+    'le': ('lt', True),
+    'eq': ('ne', False),
+    'ne': ('eq', False),
+    'lt_const': ('ge_const', False),
+    'ge_const': ('lt_const', False),
+    'gt_const': ('le_const', False),
+    'le_const': ('gt_const', False),
+    'eq_const': ('ne_const', False),
+    'ne_const': ('eq_const', False),
+}
+
+def map_addresses(instruction, f):
+    reads, write = memory_operands[instruction[0]]
+    res = list(instruction)
+    for i in reads + ((write,) if write else ()):
+        res[i] = f(res[i])
+    return res
+
+arg1 = lambda in2,args: args[1]
+no_arg = lambda in2,args: 0
+deref = lambda in2,args: in2
+offset = lambda in2,args: in2 + args[1]
+
+next_pc = lambda PC,*args: PC + 1
+
+# opcodes with a constant instead of the operand in position 2 and 3
+const_variants = {
+    'add': ('add_const', 'add_const'),
+    'mul': ('mul_const', 'mul_const'),
+    'eq': ('eq_const', 'eq_const'),
+    'ne': ('ne_const', 'ne_const'),
+    'lt': ('gt_const', 'lt_const'),
+    'le': ('ge_const', 'le_const'),
+    'sub': ('sub_const', 'rsub_const'),
+    'shr': ('shr_const', None),
+}
+
+# operand positions that determine the bit length of comparisons and
+# shifts in machine.py, only the shifted value for the latter
+comparisons = ['lt', 'le', 'eq', 'ne', 'lt_const', 'gt_const', 'le_const', \
+               'ge_const', 'eq_const', 'ne_const']
+length_operands = dict([(op, (2, 3)) for op in comparisons + \
+                        ['br_' + op for op in comparisons] + \
+                        ['ult_pos_const', 'ule_pos_const']] + \
+                       [(op, (3,)) for op in ('shr1', 'shr_const', 'shr', \
+                                              'shl')])
+
+# plain constants, as opposed to addresses of variables and code
+is_number = lambda x: type(x) is int
+
+# rough costs in secure multiplications of the machine in machine.py,
+# with the bit length of the shared ALU limited to 64
+word_bits = 64
+
+def ceil_log2(x):
+    return max(1, (int(x) - 1).bit_length())
+
+def linear_cost(size, value_length=1):
+    return word_bits + ceil_log2(size) + size * (value_length + 2)
+
+def access_cost(size, value_length=1):
+    """ Cost of an access to the cheaper of a linear scan and a tree
+    ORAM, as in machine.memory_costs(). """
+    linear = linear_cost(size, value_length)
+    tree = 0
+    while size > 2 ** 10:
+        path = 4 * (ceil_log2(size) + 1)
+        tree += 2 * path * (value_length + ceil_log2(size)) + \
+            word_bits + ceil_log2(size)
+        size = -(-size // 8)
+        value_length = 1
+    return min(linear, tree + linear_cost(size, value_length))
+
+def opcode_cost(op):
+    """ Cost that an opcode adds to every step, whichever
+    instruction is executed: the selection of its outputs, and the bit
+    decomposition of comparisons and shifts, assuming no shared ALU. """
+    res = 5
+    if op in length_operands:
+        res += 2 * word_bits
+    return res
+
+# cleartext semantics of the opcodes in machine.py
+semantics = {
+    'add': (arg1, lambda in1,in2,args: (in1 + in2, args[0], 1), next_pc),
+    'mul': (arg1, lambda in1,in2,args: (in1 * in2, args[0], 1), next_pc),
+    'lt': (arg1, lambda in1,in2,args: (int(in1 < in2), args[0], 1), next_pc),
+    'br': (no_arg, lambda in1,in2,args: (0, 0, 0), \
+               lambda PC,in1,in2,args: args[0] if in2 else args[1]),
+    'mov': (arg1, lambda in1,in2,args: (in1, args[0], 1), next_pc),
+    'load': (deref, lambda in1,in2,args: (in1, args[0], 1), next_pc),
+    'store': (arg1, lambda in1,in2,args: (in1, in2, 1), next_pc),
+    'store_const': (no_arg, lambda in1,in2,args: (args[1], args[0], 1), \
+                        next_pc),
+    'store_const_ind': (no_arg, lambda in1,in2,args: (args[1], in2, 1), \
+                            next_pc),
+    'add_const': (no_arg, lambda in1,in2,args: (args[1] + in2, args[0], 1), \
+                      next_pc),
+    'mul_const': (no_arg, lambda in1,in2,args: (args[1] * in2, args[0], 1), \
+                      next_pc),
+    'lt_const': (no_arg, lambda in1,in2,args: \
+                     (int(in2 < args[1]), args[0], 1), next_pc),
+    'gt_const': (no_arg, lambda in1,in2,args: \
+                     (int(in2 > args[1]), args[0], 1), next_pc),
+    'eq': (arg1, lambda in1,in2,args: (int(in1 == in2), args[0], 1), next_pc),
+    'eq_const': (no_arg, lambda in1,in2,args: \
+                     (int(in2 == args[1]), args[0], 1), next_pc),
+    'le': (arg1, lambda in1,in2,args: (int(in1 <= in2), args[0], 1), next_pc),
+    'le_const': (no_arg, lambda in1,in2,args: \
+                     (int(in2 <= args[1]), args[0], 1), next_pc),
+    'ge_const': (no_arg, lambda in1,in2,args: \
+                     (int(in2 >= args[1]), args[0], 1), next_pc),
+    'ne': (arg1, lambda in1,in2,args: (int(in1 != in2), args[0], 1), next_pc),
+    'ne_const': (no_arg, lambda in1,in2,args: \
+                     (int(in2 != args[1]), args[0], 1), next_pc),
+    'jmp': (no_arg, lambda in1,in2,args: (0, 0, 0), \
+                lambda PC,in1,in2,args: args[0]),
+    'jmp_ind': (no_arg, lambda in1,in2,args: (0, 0, 0), \
+                    lambda PC,in1,in2,args: in2),
+    'shr1': (no_arg, lambda in1,in2,args: (in2 >> 1, args[0], 1), next_pc),
+    'shr_const': (no_arg, lambda in1,in2,args: (in2 >> args[1], args[0], 1), \
+                      next_pc),
+    'shr': (arg1, lambda in1,in2,args: (in2 >> in1, args[0], 1), next_pc),
+    'shl': (arg1, lambda in1,in2,args: (in2 << in1, args[0], 1), next_pc),
+    'rsub_const': (no_arg, lambda in1,in2,args: (in2 - args[1], args[0], 1), \
+                       next_pc),
+    'sub_const': (no_arg, lambda in1,in2,args: (args[1] - in2, args[0], 1), \
+                      next_pc),
+    'sub': (arg1, lambda in1,in2,args: (in1 - in2, args[0], 1), next_pc),
+    'ult_pos_const': (no_arg, lambda in1,in2,args: \
+                          (int(in2 < args[1] and in2 >= 0), args[0], 1), \
+                          next_pc),
+    'ule_pos_const': (no_arg, lambda in1,in2,args: \
+                          (int(in2 <= args[1] and in2 >= 0), args[0], 1), \
+                          next_pc),
+    'and_': (arg1, lambda in1,in2,args: (in1 & in2, args[0], 1), next_pc),
+    'nop': (no_arg, lambda in1,in2,args: (0, 0, 0), next_pc),
+    'load_off': (offset, lambda in1,in2,args: (in1, args[0], 1), next_pc),
+    'store_off': (arg1, lambda in1,in2,args: (in1, in2 + args[0], 1), \
+                      next_pc),
+    'store_const_off': (no_arg, lambda in1,in2,args: \
+                            (args[1], in2 + args[0], 1), next_pc),
+}
+
+# branches to args[0] if the comparison holds and to the next
+# instruction otherwise
+for op,cond in (('lt', lambda in1,in2,args: in1 < in2),
+                ('le', lambda in1,in2,args: in1 <= in2),
+                ('eq', lambda in1,in2,args: in1 == in2),
+                ('ne', lambda in1,in2,args: in1 != in2),
+                ('lt_const', lambda in1,in2,args: in2 < args[1]),
+                ('gt_const', lambda in1,in2,args: in2 > args[1]),
+                ('le_const', lambda in1,in2,args: in2 <= args[1]),
+                ('ge_const', lambda in1,in2,args: in2 >= args[1]),
+                ('eq_const', lambda in1,in2,args: in2 == args[1]),
+                ('ne_const', lambda in1,in2,args: in2 != args[1])):
+    semantics['br_' + op] = (semantics[op][0], \
+                             lambda in1,in2,args: (0, 0, 0), \
+                             lambda PC,in1,in2,args,cond=cond: \
+                                 args[0] if cond(in1, in2, args) else PC + 1)
+
+class Emulator(object):
+    """ Cleartext execution of linked code with the semantics of
+    machine.py, including register tiers and bundles. Execution stops
+    before the first instruction reading a tainted cell, that is, a
+    cell holding secret input that has not been overwritten yet. """
+    def __init__(self, code, start=0, tainted=(), data={}, registers={}):
+        self.code = code
+        self.PC = start
+        self.data = dict(data)
+        self.registers = dict(registers)
+        self.tainted = set(tainted)
+        self.steps = 0
+        # steps per code address and memory cells accessed
+        self.counts = {}
+        self.touched = set()
+    def done(self):
+        return self.PC >= len(self.code)
+    def read(self, instruction):
+        op = instruction[0]
+        args = [int(x) for x in instruction[1:4]]
+        tiers = instruction[4] if len(instruction) > 4 else 7
+        preop = semantics[op][0]
+        reads, write = memory_operands[op]
+        space = lambda bit: self.data if tiers & bit else self.registers
+        in2 = space(1).get(args[2], 0)
+        used = [args[2]] if 3 in reads and tiers & 1 else []
+        if preop is arg1:
+            in1 = space(2).get(args[1], 0)
+            used += [args[1]] if tiers & 2 else []
+        elif preop is no_arg:
+            in1 = 0
+        else:
+            p_in1 = preop(in2, args)
+            in1 = self.data.get(p_in1, 0)
+            used.append(p_in1)
+        return op, args, tiers, in1, in2, used
+    def step(self):
+        entry = self.code[self.PC]
+        if isinstance(entry[0], str):
+            entry = [entry]
+        operands = [self.read(instruction) for instruction in entry]
+        if self.tainted.intersection(sum((x[5] for x in operands), [])):
+            return False
+        # all reads of a bundle happen before the writes
+        for op,args,tiers,in1,in2,used in operands:
+            res, p_out, write = semantics[op][1](in1, in2, args)
+            self.touched.update(used)
+            if not write:
+                continue
+            if memory_operands[op][1] is None or tiers & 4:
+                self.data[p_out] = res
+                self.tainted.discard(p_out)
+                self.touched.add(p_out)
+            else:
+                self.registers[p_out] = res
+        op, args, tiers, in1, in2, used = operands[-1]
+        self.counts[self.PC] = self.counts.get(self.PC, 0) + 1
+        self.PC = semantics[op][2](self.PC, in1, in2, args)
+        self.steps += 1
+        return True
+    def run(self, max_steps=float('inf')):
+        while not self.done() and self.steps < max_steps and self.step():
+            pass
+
 class BasicBlock(object):
     def __init__(self, basic_block, function):
         self.function = function
@@ -74,6 +422,17 @@ class BasicBlock(object):
             basic_block.instructions[0].opcode_name == 'br' and \
             len(basic_block.instructions[0].operands) == 1
         self.phi_inst = []
+        self.phi_dest = {}
+        phis = [inst for inst in basic_block.instructions \
+                    if inst.opcode_name == 'phi']
+        # the incoming values go to a second cell copied on entry if
+        # copying them straight into the phi cells could overwrite values
+        # still needed, on a conditional edge or by another phi here
+        self.split_phi = any(len(phi.get_incoming_block(i).instructions[-1] \
+                                     .operands) > 1 or \
+                                 phi.get_incoming_value(i) in phis \
+                                 for phi in phis \
+                                 for i in range(phi.incoming_count))
         for inst in basic_block.instructions:
             op = inst.opcode_name
             if op == 'alloca':
@@ -116,17 +475,22 @@ class BasicBlock(object):
         return self.vars[inst]
     def alloc(self, size):
         return self.function.alloc(size)
+    def alloc_temp(self):
+        return self.function.alloc_temp()
     def alloca(self, inst):
         return Value.get_variable(inst, self)
     def compute_constant_expr(self, expr):
         base = self.vars[expr.operands[0]]
-        offset = 0
-        t = expr.operands[0].type.pointee
-        for index in expr.operands[1:-1]:
-            offset += index.s_ext_value
-            offset *= t.count
-            t = t.element
-        offset += expr.operands[-1].s_ext_value
+        t = get_source_type(expr)
+        offset = expr.operands[1].s_ext_value * get_size(t)[0]
+        # same strides as getelementptr()
+        for index in expr.operands[2:]:
+            if isinstance(t, StructType):
+                offset += get_struct_offset(t, index.s_ext_value)
+                t = t.elements[index.s_ext_value]
+            else:
+                t = t.element
+                offset += index.s_ext_value * get_array_type(t)[0]
         res = get_value(base + offset, t, start_depth=1)
         res.direct = True
         return res
@@ -177,14 +541,14 @@ class BasicBlock(object):
                 # code = ('mov', dest, src, 0)
                 # self.instructions.append(code)
             else:
-                dest = Value(self.alloc(1))
+                dest = Value(self.alloc_temp())
                 dest.depth = src.depth - 1
                 dest.direct = False
                 self.vars[inst] = dest
                 code = ('load', dest, 0, src)
                 self.instructions.append(code)
     def binary(self, inst, op, operands=None):
-        dest = Ref(self.alloc(1), False)
+        dest = Ref(self.alloc_temp(), False)
         self.vars[inst] = dest
         src = [None] * 2
         n_const = 0
@@ -193,9 +557,6 @@ class BasicBlock(object):
                 src[1] = src[0]
                 src[0] = operand.s_ext_value
                 n_const += 1
-            elif isinstance(operand, Argument):
-                src[i] = self.alloc(1)
-                self.vars[operand] = src[i]
             elif operand.opcode_name == 'inttoptr':
                 src[1] = src[0]
                 src[0] = operand.operands[0].s_ext_value
@@ -222,7 +583,7 @@ class BasicBlock(object):
     def getelementptr(self, inst):
         base = self.vars[inst.operands[0]]
         offset = inst.operands[-1]
-        t = inst.operands[0].type.pointee
+        t = get_source_type(inst)
         if isinstance(t, ArrayType):
             step = get_array_type(t.element)[0]
         else:
@@ -236,17 +597,17 @@ class BasicBlock(object):
                 self.vars[inst] = Value(base + abs_offset)
                 self.vars[inst].direct = True
             else:
-                res = Value(self.alloc(1))
+                res = Value(self.alloc_temp())
                 code = ('add_const', res, abs_offset, base)
                 self.instructions.append(code)
                 self.vars[inst] = res
                 self.vars[inst].direct = False
         else:
-            res = Value(self.alloc(1))
+            res = Value(self.alloc_temp())
             if step == 1:
                 tmp = self.vars[offset]
             else:
-                tmp = Value(self.alloc(1))
+                tmp = Value(self.alloc_temp())
                 code = ('mul_const', tmp, step, self.vars[offset])
                 self.instructions.append(code)
             if base.direct:
@@ -298,7 +659,7 @@ class BasicBlock(object):
             if by == 0:
                 self.vars[inst] = n
             else:
-                res = Ref(self.alloc(1), False)
+                res = Ref(self.alloc_temp(), False)
                 if by == 1:
                     code = ('shr1', res, 0, n)
                 else:
@@ -306,9 +667,9 @@ class BasicBlock(object):
                 self.instructions.append(code)
                 self.vars[inst] = res
         else:
-            res = Ref(self.alloc(1), False)
+            res = Ref(self.alloc_temp(), False)
             if isinstance(inst.operands[0], ConstantInt):
-                n = Ref(self.alloc(1), False)
+                n = Ref(self.alloc_temp(), False)
                 code = ('store_const', n, inst.operands[0].s_ext_value, 0)
                 self.instructions.append(code)
             else:
@@ -317,14 +678,14 @@ class BasicBlock(object):
             self.instructions.append(code)
             self.vars[inst] = res
     def shl(self, inst):
-        res = Ref(self.alloc(1), False)
+        res = Ref(self.alloc_temp(), False)
         by = inst.operands[1]
         if isinstance(by, ConstantInt):
             code = ('mul_const', res, 1 << by.s_ext_value, \
                         self.vars[inst.operands[0]])
         else:
             if isinstance(inst.operands[0], ConstantInt):
-                n = Ref(self.alloc(1), False)
+                n = Ref(self.alloc_temp(), False)
                 code = ('store_const', n, inst.operands[0].s_ext_value, 0)
                 self.instructions.append(code)
             else:
@@ -334,8 +695,13 @@ class BasicBlock(object):
         self.vars[inst] = res
     def zext(self, inst):
         self.vars[inst] = self.get_var(inst.operands[0])
+        if inst.opcode_name == 'trunc':
+            # the value is not truncated in the machine
+            program = self.function.program
+            program.min_width = max(program.min_width, \
+                                    inst.operands[0].type.width)
     def sub(self, inst):
-        res = Ref(self.alloc(1), False)
+        res = Ref(self.alloc_temp(), False)
         if isinstance(inst.operands[0], ConstantInt):
             code = ('sub_const', res, inst.operands[0].s_ext_value, \
                         self.vars[inst.operands[1]])
@@ -361,10 +727,13 @@ class BasicBlock(object):
     def call(self, inst):
         if inst.operands[-1].name.startswith('llvm.'):
             return
+        if inst.operands[-1].name == 'input_array':
+            self.input_array(inst)
+            return
         code = [list(self.store_direct(0, operand)) \
                     for operand,t in zip(inst.operands[:-1], \
                                              inst.operands[-1].type.pointee.args)]
-        tmp = get_value(self.alloc(1), \
+        tmp = get_value(self.alloc_temp(), \
                             inst.operands[-1].type.pointee.return_type, start_depth=1)
         tmp.direct = False
         code += [['store_const', 0, 0, 0], \
@@ -374,9 +743,29 @@ class BasicBlock(object):
         self.function.program.calls.append((inst, code, self, \
                                                 len(self.instructions) + 2))
         self.instructions += code
+    def input_array(self, inst):
+        """ input_array(ptr, len, party) reserves a region for secret
+        input, which the machine reads before execution starts. """
+        ptr, length, party = inst.operands[:3]
+        if isinstance(ptr, ConstantExpr):
+            dest = self.compute_constant_expr(ptr)
+        else:
+            dest = self.vars[ptr]
+        if not dest.direct or not isinstance(length, ConstantInt) or \
+           not isinstance(party, ConstantInt):
+            raise Exception('not implemented: input_array() with ' \
+                            'non-constant arguments')
+        self.function.program.inputs.append( \
+            (int(dest), length.s_ext_value, party.s_ext_value))
     def phi(self, inst):
         self.phi_inst.append(inst)
-        self.vars[inst] = Ref(self.alloc(1), False)
+        self.vars[inst] = Ref(self.alloc_temp(), False)
+        if self.split_phi:
+            self.phi_dest[inst] = Ref(self.alloc_temp(), False)
+            self.instructions.append(('mov', self.vars[inst], \
+                                      self.phi_dest[inst], 0))
+        else:
+            self.phi_dest[inst] = self.vars[inst]
 
 class Function(object):
     def __init__(self, function, program):
@@ -398,6 +787,12 @@ class Function(object):
             bb = BasicBlock(basic_block, self)
             self.basic_blocks.append(bb)
             self.basic_block_ref[basic_block] = bb
+        for bb in self.basic_blocks:
+            for phi in bb.phi_inst:
+                for i in range(phi.incoming_count):
+                    # keep blocks that only jump if they carry phi copies
+                    self.basic_block_ref[phi.get_incoming_block(i)] \
+                        .redundant = False
         start = 0
         for i,bb in enumerate(self.basic_blocks):
             if bb.redundant:
@@ -416,11 +811,12 @@ class Function(object):
                     bb.exit = None
                 next_blocks = operands if len(operands) == 1 else operands[1:]
                 for next_block in next_blocks:
-                    for phi in self.basic_block_ref[next_block].phi_inst:
+                    next_bb = self.basic_block_ref[next_block]
+                    for phi in next_bb.phi_inst:
                         for i in range(phi.incoming_count):
                             if self.basic_block_ref[phi.get_incoming_block(i)] \
                                is bb:
-                                code = bb.store_direct(self.vars[phi], \
+                                code = bb.store_direct(next_bb.phi_dest[phi], \
                                                        phi.get_incoming_value(i))
                                 bb.instructions.append(code)
                                 break
@@ -449,6 +845,8 @@ class Function(object):
         return self.length
     def alloc(self, size):
         return self.program.alloc(size)
+    def alloc_temp(self):
+        return self.program.alloc_temp()
     def output(self):
         print('# %s()' % self.name)
         for bb in self.basic_blocks:
@@ -456,8 +854,11 @@ class Function(object):
                 print('\t# %s:' % bb.name)
             for i,instruction in enumerate(bb.instructions):
                 if asm_output:
-                    print('\t\t', instruction[0], \
-                        ' '.join(str(int(x)) for x in instruction[1:]), \
+                    if isinstance(instruction[0], str):
+                        instruction = [instruction]
+                    print('\t\t', ' | '.join('%s %s' % (x[0], \
+                        ' '.join(str(int(y)) for y in x[1:])) \
+                                                 for x in instruction), \
                         '#', self.start + bb.start + i)
                 else:
                     print('\t\t', instruction, ', #', self.start + bb.start + i)
@@ -467,20 +868,27 @@ class Program(object):
         self.N = N
         self.vars = {}
         self.n_vars = 0
+        self.n_temps = 0
+        self.n_array_vars = None
+        self.n_registers = None
+        self.min_width = 1
+        self.bit_lengths = {}
+        self.allocations = []
         self.initial_data = {}
+        self.initial_registers = {}
+        # original cell to cell after split_memory()
+        self.layout = {}
+        # secret input regions (address, length, party)
+        self.inputs = []
         for var in module.global_variables:
-            if not var.global_constant:
-                v = Value.get_variable(var, self)
-                init = var.initializer
-                if isinstance(init, ConstantInt):
-                    if init.s_ext_value != 0:
-                        raise Exception('not implemented: variable initialization')
-                elif isinstance(init, ConstantAggregateZero):
-                    pass
-                elif isinstance(init, ConstantDataArray):
-                    raise Exception('not implemented: array initialization')
-                else:
-                    raise Exception('not implemented: unknown initialization')
+            v = Value.get_variable(var, self)
+            init = var.initializer
+            # zero-initialized variables stand in for input
+            if var.global_constant or not \
+               isinstance(init, (ConstantInt, ConstantAggregateZero)) or \
+               isinstance(init, ConstantInt) and init.s_ext_value != 0:
+                for i,x in enumerate(get_initializer(init)):
+                    self.initial_data[int(v) + i] = x
         self.n_global_vars = self.n_vars
         self.calls = []
         self.functions = []
@@ -501,28 +909,853 @@ class Program(object):
                 code[i][1] = arg
             n_args = len(called_function.args)
             code[n_args+0][1] = called_function.return_address
-            code[n_args+0][2] = bb.function.start + bb.start + offset + n_args
+            code[n_args+0][2] = \
+                Label(bb.function.start + bb.start + offset + n_args)
             code[n_args+1][1] = called_function.start
             code[n_args+2][2] = called_function.return_value
-        try:
-            self.main = self.function_ref[module.get_function_named('main')]
+        for address,bb,i in self.code():
+            op = bb.instructions[i][0]
+            if op not in memory_operands:
+                raise Exception('unsupported instruction in %s(): %s' % \
+                                (bb.function.name, op))
+        mains = [f for f in self.functions if f.name == 'main']
+        if mains:
+            self.main = mains[0]
             self.check = self.main.return_value
-        except llvm.LLVMException:
+        else:
             self.main = self.functions[0]
             self.check = 2
         self.main.exit[:] = ['jmp', self.length, 0, 0]
+        # relocated by rewrite()
+        self.start = self.main.start
+        if optimize:
+            self.optimize()
+        if fusion:
+            self.fuse()
+        self.infer_bit_lengths()
+        self.allocate_temps()
+        if split_memory:
+            self.split_memory()
+        if n_registers is not None:
+            self.assign_registers()
+        if bundle_width is not None:
+            self.bundle()
+        # last because rewrite() does not relocate code addresses stored
+        # by the prefix
+        if evaluate_prefix:
+            self.evaluate_prefix()
+        if profile:
+            self.profile()
         if debug:
             self.debug()
     def alloc(self, size):
         loc = self.n_vars
         self.n_vars += size
+        self.allocations.append((loc, size))
         return loc
+    def cell(self, x):
+        return self.layout.get(x, x)
+    def global_cells(self):
+        """ Cells of the global variables, which hold the placeholder
+        input 32 + i % 96 for the i-th one. """
+        return [self.cell(x) for x in range(self.n_global_vars)]
+    def alloc_temp(self):
+        # temporaries are numbered negatively until allocate_temps()
+        self.n_temps += 1
+        return -self.n_temps
+    def get_code(self):
+        res = [None] * self.length
+        for address,bb,i in self.code():
+            res[address] = bb.instructions[i]
+        return res
+    def code(self):
+        for function in self.functions:
+            for bb in function.basic_blocks:
+                for i,instruction in enumerate(bb.instructions):
+                    yield function.start + bb.start + i, bb, i
+    def successors(self):
+        # calls store the return site in the return address of the callee
+        return_sites = {}
+        for address,bb,i in self.code():
+            instruction = bb.instructions[i]
+            if instruction[0] == 'store_const' and \
+               isinstance(instruction[2], Label):
+                return_sites.setdefault(int(instruction[1]), []).append( \
+                    int(instruction[2]))
+        res = {}
+        for address,bb,i in self.code():
+            instruction = bb.instructions[i]
+            op = instruction[0]
+            if op == 'jmp':
+                res[address] = [instruction[1]]
+            elif op == 'br':
+                res[address] = [instruction[1], instruction[2]]
+            elif op == 'jmp_ind':
+                res[address] = return_sites.get(int(instruction[3]), [])
+            elif op.startswith('br_'):
+                res[address] = [instruction[1], address + 1]
+            else:
+                res[address] = [address + 1]
+        return res
+    def liveness(self):
+        """ Temporaries live after each instruction. """
+        uses = {}
+        defs = {}
+        for address,bb,i in self.code():
+            reads, write = memory_operands[bb.instructions[i][0]]
+            uses[address] = set(x for x in (bb.instructions[i][j] \
+                                                for j in reads) if x < 0)
+            if write and bb.instructions[i][write] < 0:
+                defs[address] = bb.instructions[i][write]
+        successors = self.successors()
+        predecessors = dict((address, []) for address in successors)
+        for address,next in successors.items():
+            for x in next:
+                if x in predecessors:
+                    predecessors[x].append(address)
+        live_in = dict((address, set()) for address in successors)
+        live_out = dict((address, set()) for address in successors)
+        todo = set(successors)
+        while todo:
+            address = todo.pop()
+            out = set()
+            for x in successors[address]:
+                out |= live_in.get(x, set())
+            live_out[address] = out
+            new_in = uses[address] | (out - set([defs.get(address)]))
+            if new_in != live_in[address]:
+                live_in[address] = new_in
+                todo.update(predecessors[address])
+        return live_out, defs, live_in.get(self.main.start, set())
+    def optimize(self):
+        """ Simplify the code until nothing changes. Removed
+        instructions are skipped by relinking. """
+        length = self.length
+        changed = True
+        while changed:
+            changed = False
+            for step in (self.propagate_constants, self.eliminate_dead_code, \
+                         self.thread_jumps):
+                changes = step(self.get_code())
+                if changes:
+                    for address,bb,i in self.code():
+                        if address in changes:
+                            bb.instructions[i] = changes[address]
+                    self.rewrite(lambda instruction: \
+                                     [instruction] if instruction else [])
+                    changed = True
+        if verbose:
+            print('%d of %d instructions removed by optimization' % \
+                  (length - self.length, length), file=sys.stderr)
+    def propagate_constants(self, code):
+        """ Constant and copy propagation for temporaries with a single
+        definition that is executed before any use. """
+        live_out, defs, live_at_start = self.liveness()
+        n_defs = {}
+        for temp in defs.values():
+            n_defs[temp] = n_defs.get(temp, 0) + 1
+        constants = {}
+        copies = {}
+        for address,temp in defs.items():
+            instruction = code[address]
+            if n_defs[temp] > 1 or temp in live_at_start:
+                continue
+            if instruction[0] == 'store_const' and \
+               not isinstance(instruction[2], Label):
+                constants[temp] = instruction[2]
+            elif instruction[0] == 'mov' and int(instruction[2]) < 0 and \
+                 n_defs.get(int(instruction[2])) == 1 and \
+                 int(instruction[2]) not in live_at_start:
+                copies[temp] = instruction[2]
+        def source(x):
+            while int(x) in copies:
+                x = copies[int(x)]
+            return x
+        changes = {}
+        for address,instruction in enumerate(code):
+            op = instruction[0]
+            reads, write = memory_operands[op]
+            res = list(instruction)
+            for j in reads:
+                res[j] = source(res[j])
+            known = dict((j, constants[int(res[j])]) for j in reads \
+                             if int(res[j]) in constants)
+            numbers = all(is_number(res[j]) for j in (2, 3) if j not in reads)
+            if op == 'mov' and int(res[1]) == int(res[2]):
+                res = None
+            elif op == 'mov' and 2 in known:
+                res = ['store_const', res[1], known[2], 0]
+            elif op == 'load' and 3 in known:
+                res = ['mov', res[1], known[3], 0]
+            elif op == 'store' and 3 in known:
+                res = ['mov', known[3], res[2], 0]
+            elif op == 'store_const_ind' and 3 in known:
+                res = ['store_const', known[3], res[2], 0]
+            elif op == 'br' and 3 in known and is_number(known[3]):
+                res = ['jmp', res[1] if known[3] else res[2], 0, 0]
+            elif reads and write == 1 and op != 'load' and numbers and \
+                 len(known) == len(reads) and \
+                 all(is_number(x) for x in known.values()):
+                postop = semantics[op][1]
+                value = postop(known.get(2, 0), known.get(3, 0), res[1:])[0]
+                res = ['store_const', res[1], value, 0]
+            elif op in const_variants and len(known) == 1:
+                j, = known
+                variant = const_variants[op][j - 2]
+                if variant and is_number(known[j]):
+                    res = [variant, res[1], known[j], res[5 - j]]
+            elif is_number(res[2]) and \
+                 (op in ('add_const', 'rsub_const', 'shr_const') and \
+                      res[2] == 0 or op == 'mul_const' and res[2] == 1):
+                res = ['mov', res[1], res[3], 0]
+            elif op == 'mul_const' and is_number(res[2]) and res[2] == 0:
+                res = ['store_const', res[1], 0, 0]
+            if res is None or res != list(instruction):
+                changes[address] = res if res is None else tuple(res)
+        # write directly to the destination of a copy from the result
+        # of the previous instruction
+        n_uses = {}
+        predecessors = {}
+        for address,next in self.successors().items():
+            for x in next:
+                predecessors.setdefault(x, []).append(address)
+            for j in memory_operands[code[address][0]][0]:
+                n_uses[int(code[address][j])] = \
+                    n_uses.get(int(code[address][j]), 0) + 1
+        for address,instruction in enumerate(code):
+            # not if the uses of the destination are being redirected
+            if instruction[0] == 'mov' and int(instruction[2]) < 0 and \
+               n_uses[int(instruction[2])] == 1 and \
+               int(instruction[1]) not in copies and \
+               predecessors.get(address) == [address - 1] and \
+               address != self.start and \
+               not changes.keys() & set([address, address - 1]):
+                write = memory_operands[code[address - 1][0]][1]
+                if write and int(code[address - 1][write]) == \
+                   int(instruction[2]):
+                    res = list(code[address - 1])
+                    res[write] = instruction[1]
+                    changes[address - 1] = tuple(res)
+                    changes[address] = None
+        return changes
+    def eliminate_dead_code(self, code):
+        """ Remove unreachable instructions, writes to dead temporaries,
+        and writes overwritten later in the same basic block. """
+        successors = self.successors()
+        reachable = set()
+        todo = [self.start]
+        while todo:
+            address = todo.pop()
+            if address in successors and address not in reachable:
+                reachable.add(address)
+                todo += successors[address]
+        changes = dict((address, None) for address in successors \
+                           if address not in reachable)
+        live_out, defs, live_at_start = self.liveness()
+        for address,temp in defs.items():
+            if temp not in live_out[address]:
+                changes[address] = None
+        leaders = set()
+        for address,instruction in enumerate(code):
+            if instruction[0] in ('jmp', 'br', 'jmp_ind'):
+                leaders.update(successors[address])
+        pending = {}
+        for address,instruction in enumerate(code):
+            op = instruction[0]
+            reads, write = memory_operands[op]
+            if address in leaders or op in ('load', 'store', 'store_const_ind'):
+                pending = {}
+            for j in reads:
+                pending.pop(int(instruction[j]), None)
+            if write:
+                if int(instruction[write]) in pending:
+                    changes[pending[int(instruction[write])]] = None
+                pending[int(instruction[write])] = address
+            if op in ('jmp', 'br', 'jmp_ind'):
+                pending = {}
+        return changes
+    def thread_jumps(self, code):
+        """ Jump straight to the final target of jump chains and remove
+        jumps to the next instruction. """
+        def target(address):
+            seen = set()
+            while address < len(code) and code[address][0] == 'jmp' and \
+                  address not in seen:
+                seen.add(address)
+                address = code[address][1]
+            return address
+        changes = {}
+        for address,instruction in enumerate(code):
+            if instruction[0] == 'jmp':
+                new = target(instruction[1])
+                if new == address + 1:
+                    changes[address] = None
+                elif new != instruction[1]:
+                    changes[address] = ('jmp', new, 0, 0)
+            elif instruction[0] == 'br':
+                new = target(instruction[1]), target(instruction[2])
+                if new[0] == new[1]:
+                    changes[address] = ('jmp', new[0], 0, 0)
+                elif new != tuple(instruction[1:3]):
+                    changes[address] = ('br',) + new + (instruction[3],)
+        return changes
+    def fuse(self):
+        """ Replace a temporary computed only for the next instruction
+        by a fused opcode: address computation and load or store, and
+        comparison and branch if one branch target is the next
+        instruction. A fused opcode is used if the steps it saves in the
+        static count outweigh the cost of the additional opcode in every
+        step, estimated with as many steps as instructions. Address
+        computations with mul_const are not fused because the result
+        would need a fourth operand. """
+        code = self.get_code()
+        live_out, defs, live_at_start = self.liveness()
+        n_defs = {}
+        for temp in defs.values():
+            n_defs[temp] = n_defs.get(temp, 0) + 1
+        n_uses = {}
+        predecessors = {}
+        for address,next in self.successors().items():
+            for x in next:
+                predecessors.setdefault(x, []).append(address)
+            for j in memory_operands[code[address][0]][0]:
+                n_uses[int(code[address][j])] = \
+                    n_uses.get(int(code[address][j]), 0) + 1
+        def fused(first, second, address):
+            op = first[0]
+            temp = first[1]
+            if second[0] == 'load' and op == 'add_const':
+                return ('load_off', second[1], first[2], first[3])
+            elif second[0] == 'store' and op == 'add_const' and \
+                 int(second[2]) != temp:
+                return ('store_off', first[2], second[2], first[3])
+            elif second[0] == 'store_const_ind' and op == 'add_const':
+                return ('store_const_off', first[2], second[2], first[3])
+            elif second[0] == 'br' and op in negations:
+                if second[2] == address + 2:
+                    return ('br_' + op, second[1], first[2], first[3])
+                elif second[1] == address + 2:
+                    op, swap = negations[op]
+                    args = (first[3], first[2]) if swap else first[2:]
+                    return ('br_' + op, second[2]) + tuple(args)
+        candidates = []
+        for address,first in enumerate(code[:-1]):
+            write = memory_operands[first[0]][1]
+            if write is None:
+                continue
+            temp = int(first[write])
+            if temp < 0 and n_defs.get(temp) == 1 and \
+               temp not in live_at_start and n_uses.get(temp) == 1 and \
+               predecessors.get(address + 1) == [address] and \
+               address + 1 != self.start and \
+               int(code[address + 1][3]) == temp:
+                res = fused(first, code[address + 1], address)
+                if res:
+                    candidates.append((address, res))
+        counts = {}
+        for address,res in candidates:
+            counts[res[0]] = counts.get(res[0], 0) + 1
+        ops = set(instruction[0] for instruction in code)
+        chosen = set()
+        # code entry and two reads and a write of data per step
+        n_cells = max(self.n_vars + self.n_temps, self.N)
+        step_cost = access_cost(len(code), 4) + 3 * access_cost(n_cells)
+        cost = lambda ops: sum(opcode_cost(op) for op in ops)
+        for op in sorted(counts, key=lambda op: -counts[op]):
+            # fusion can also remove the last use of an opcode
+            trial = chosen | set([op])
+            fused_away = set()
+            for address,res in candidates:
+                if res[0] in trial:
+                    fused_away.update((address, address + 1))
+            new_ops = trial | set(instruction[0] for address,instruction \
+                                      in enumerate(code) \
+                                      if address not in fused_away)
+            if counts[op] * step_cost > \
+               (cost(new_ops) - cost(ops)) * len(code):
+                chosen = trial
+                ops = new_ops
+        changes = {}
+        for address,res in candidates:
+            if res[0] in chosen and address not in changes:
+                changes[address] = res
+                changes[address + 1] = None
+        for address,bb,i in self.code():
+            if address in changes:
+                bb.instructions[i] = changes[address]
+        self.rewrite(lambda instruction: [instruction] if instruction else [])
+        if verbose:
+            print('fused %d instruction pairs into %s' % \
+                  (len(changes) // 2, \
+                   ', '.join(sorted(chosen)) or 'nothing'), file=sys.stderr)
+    def allocate_temps(self):
+        """ Place temporaries after the other variables, sharing slots
+        between temporaries whose lifetimes do not overlap. """
+        interference = dict((-i, set()) for i in range(1, self.n_temps + 1))
+        if reuse_slots:
+            live_out, defs, live_at_start = self.liveness()
+            for address,temp in defs.items():
+                for other in live_out[address]:
+                    if other != temp:
+                        interference[temp].add(other)
+                        interference[other].add(temp)
+            # uninitialized temporaries keep their initial zero
+            for temp in live_at_start:
+                interference[temp] = set(interference) - set([temp])
+                for other in interference[temp]:
+                    interference[other].add(temp)
+        else:
+            for temp in interference:
+                interference[temp] = set(interference) - set([temp])
+        slots = {}
+        for temp in sorted(interference, reverse=True):
+            used = set(slots.get(other) for other in interference[temp])
+            slot = 0
+            while slot in used:
+                slot += 1
+            slots[temp] = slot
+        base = self.n_vars
+        n_slots = max(slots.values()) + 1 if slots else 0
+        self.n_vars += n_slots
+        self.temp_cells = set(range(base, base + n_slots))
+        def relocate(x):
+            if x < 0:
+                res = Value(base + slots[x])
+                res.depth = getattr(x, 'depth', 0)
+                res.direct = False
+                return res
+            else:
+                return x
+        for address,bb,i in self.code():
+            instruction = bb.instructions[i]
+            new = map_addresses(instruction, relocate)
+            if isinstance(instruction, list):
+                instruction[:] = new
+            else:
+                bb.instructions[i] = tuple(new)
+        if verbose:
+            print('%d temporaries in %d slots' % (self.n_temps, n_slots), \
+                  file=sys.stderr)
+    def rewrite(self, f):
+        """ Replace every instruction by the list of instructions
+        returned by f and update the code addresses. """
+        replacements = [(address, bb, f(bb.instructions[i])) \
+                            for address,bb,i in self.code()]
+        for function in self.functions:
+            for bb in function.basic_blocks:
+                bb.instructions = []
+        new_address = {}
+        pending = []
+        start = 0
+        for address,bb,instructions in replacements:
+            pending.append(address)
+            if instructions:
+                for x in pending:
+                    new_address[x] = start
+                pending = []
+            bb.instructions += instructions
+            start += len(instructions)
+        for x in pending + [self.length]:
+            new_address[x] = start
+        start = 0
+        for function in self.functions:
+            function.start = start
+            for bb in function.basic_blocks:
+                bb.start = start - function.start
+                start += len(bb.instructions)
+            function.length = start - function.start
+        self.length = start
+        self.start = new_address[self.start]
+        def relink(instruction):
+            if not isinstance(instruction[0], str):
+                return tuple(relink(x) for x in instruction)
+            res = list(instruction)
+            if res[0] == 'jmp' or res[0].startswith('br_'):
+                res[1] = new_address[res[1]]
+            elif res[0] == 'br':
+                res[1:3] = [new_address[res[1]], new_address[res[2]]]
+            for i,x in enumerate(res):
+                if isinstance(x, Label):
+                    res[i] = Label(new_address[x])
+            return type(instruction)(res)
+        for address,bb,i in self.code():
+            bb.instructions[i] = relink(bb.instructions[i])
+        return new_address
+    def split_memory(self):
+        """ Place the allocations whose address is used as a pointer
+        value in an array region at the start of memory and all other
+        cells in a scalar region after it. Instructions access scalars
+        directly and array cells only via load and store. """
+        allocations = sorted(self.allocations)
+        starts = [start for start,size in allocations]
+        def allocation(address):
+            return allocations[max(0, bisect.bisect_right(starts, address) - 1)]
+        def pointers(instruction):
+            reads, write = memory_operands[instruction[0]]
+            for i,x in enumerate(instruction[1:], 1):
+                if isinstance(x, Value) and i not in reads and i != write:
+                    yield i, x
+        arrays = set()
+        for address,bb,i in self.code():
+            for j,x in pointers(bb.instructions[i]):
+                arrays.add(allocation(x))
+        array_cells = set()
+        for start,size in arrays:
+            array_cells.update(range(start, start + size))
+        scratch = [self.alloc(1) for i in range(3)]
+        pool = {}
+        def pointer(address):
+            if address not in pool:
+                pool[address] = self.alloc(1)
+            return pool[address]
+        def split(instruction):
+            op = instruction[0]
+            reads, write = memory_operands[op]
+            res = list(instruction)
+            before = []
+            after = []
+            for k,i in enumerate(reads):
+                if int(res[i]) in array_cells:
+                    before.append(('load', scratch[k], 0, pointer(int(res[i]))))
+                    res[i] = scratch[k]
+            if write and int(res[write]) in array_cells:
+                address = pointer(int(res[write]))
+                if op == 'store_const':
+                    return before + [('store_const_ind', 0, res[2], address)]
+                after.append(('store', 0, scratch[2], address))
+                res[write] = scratch[2]
+            return before + [type(instruction)(res)] + after
+        self.rewrite(split)
+        # new layout
+        new_address = {}
+        for x in sorted(array_cells):
+            new_address[x] = len(new_address)
+        self.n_array_vars = len(new_address)
+        for x in range(self.n_vars):
+            if x not in array_cells:
+                new_address[x] = len(new_address)
+        def relocate(x):
+            res = Value(new_address[int(x)])
+            res.depth = getattr(x, 'depth', 0)
+            res.direct = getattr(x, 'direct', False)
+            return res
+        def relocate_pointer(x):
+            start, size = allocation(int(x))
+            res = relocate(start)
+            return Value(res + int(x) - start)
+        for address,bb,i in self.code():
+            res = map_addresses(bb.instructions[i], relocate)
+            for j,x in pointers(bb.instructions[i]):
+                res[j] = relocate_pointer(x)
+            if 3 not in memory_operands[res[0]][0]:
+                # the machine always reads this operand from the scalars
+                res[3] = self.n_array_vars
+            bb.instructions[i] = type(bb.instructions[i])(res)
+        self.layout = new_address
+        self.check = relocate(self.check)
+        self.initial_data = dict((int(relocate(x)), value) \
+                                 for x,value in self.initial_data.items())
+        for i,(address,length,party) in enumerate(self.inputs):
+            assert [int(relocate(address + j)) for j in range(length)] == \
+                list(range(int(relocate(address)), \
+                           int(relocate(address)) + length))
+            self.inputs[i] = (int(relocate(address)), length, party)
+        for address,cell in pool.items():
+            self.initial_data[int(relocate(cell))] = int(relocate_pointer(address))
+        # none of these cells has its address taken
+        self.temp_cells = set(int(relocate(x)) for x in self.temp_cells | \
+                                  set(scratch) | set(pool.values()))
+        if verbose:
+            print('%d array cells, %d scalar cells' % \
+                  (self.n_array_vars, self.n_vars - self.n_array_vars), \
+                  file=sys.stderr)
+    def assign_registers(self):
+        """ Move the most used temporaries to a register file. The
+        machine reads at most one operand per step from memory, so the
+        other one and pointers for loads go via scratch register 0. The
+        tier bits (in2, in1, output in memory) are appended to every
+        instruction, and register operands become register indices. """
+        uses = {}
+        for address,bb,i in self.code():
+            instruction = bb.instructions[i]
+            reads, write = memory_operands[instruction[0]]
+            for j in reads + ((write,) if write else ()):
+                if int(instruction[j]) in self.temp_cells:
+                    uses[int(instruction[j])] = \
+                        uses.get(int(instruction[j]), 0) + 1
+        chosen = sorted(uses, key=lambda x: (-uses[x], x))[:n_registers - 1]
+        registers = dict((x, i + 1) for i,x in enumerate(sorted(chosen)))
+        self.n_registers = len(registers) + 1
+        def encode(instruction, scratch=None):
+            reads, write = memory_operands[instruction[0]]
+            res = list(instruction)
+            tiers = 0
+            for j,bit in ((3, 1), (2, 2), (write, 4)):
+                if j is None:
+                    continue
+                elif j == scratch:
+                    res[j] = 0
+                elif j in reads or j == write:
+                    if int(res[j]) in registers:
+                        res[j] = registers[int(res[j])]
+                    else:
+                        tiers |= bit
+            if 3 not in reads:
+                res[3] = 0
+            return type(instruction)(res + [tiers])
+        def tier(instruction):
+            op = instruction[0]
+            reads, write = memory_operands[op]
+            in_memory = [j for j in reads \
+                             if int(instruction[j]) not in registers]
+            if (semantics[op][0] in (deref, offset) and in_memory) or \
+               len(in_memory) > 1:
+                j = in_memory[-1]
+                return [encode(('mov', 0, instruction[j], 0), 1), \
+                        encode(instruction, j)]
+            return [encode(instruction)]
+        self.rewrite(tier)
+        for x in list(self.initial_data):
+            if x in registers:
+                self.initial_registers[registers[x]] = self.initial_data.pop(x)
+        if verbose:
+            print('%d of %d temporaries in registers' % \
+                  (len(registers), len(self.temp_cells)), file=sys.stderr)
+    def bundle(self):
+        """ Schedule independent instructions of straight-line code
+        into bundles of bundle_width instructions, padded with nop.
+        Control flow only leaves a bundle from its last instruction,
+        and jumps only go to the start of a bundle. """
+        code = self.get_code()
+        successors = self.successors()
+        control = lambda op: op in ('jmp', 'br', 'jmp_ind') or \
+            op.startswith('br_')
+        leaders = set([self.start])
+        for address,instruction in enumerate(code):
+            if control(instruction[0]):
+                leaders.update(successors[address])
+        def accesses(instruction):
+            op = instruction[0]
+            reads, write = memory_operands[op]
+            # cells are (in memory, address), the rest are registers
+            tiers = instruction[4] if len(instruction) > 4 else 7
+            in_memory = {3: tiers & 1, 2: tiers & 2, write: tiers & 4}
+            cell = lambda j: (bool(in_memory[j]), int(instruction[j]))
+            return set(cell(j) for j in reads), \
+                set([cell(write)] if write else []), \
+                semantics[op][0] in (deref, offset), \
+                op in ('store', 'store_const_ind', 'store_off', \
+                       'store_const_off')
+        def pointed(cells):
+            return any(in_memory and address not in self.temp_cells and \
+                       (self.n_array_vars is None or \
+                        address < self.n_array_vars) \
+                       for in_memory,address in cells)
+        def reads_result(x, y):
+            (r1, w1, ir1, iw1), (r2, w2, ir2, iw2) = x, y
+            return w1 & r2 or iw1 and (ir2 or pointed(r2)) or \
+                ir2 and pointed(w1)
+        def overwrites(x, y):
+            (r1, w1, ir1, iw1), (r2, w2, ir2, iw2) = x, y
+            return (r1 | w1) & w2 or iw1 and pointed(w2) or \
+                iw2 and (ir1 or iw1 or pointed(r1 | w1))
+        nop = ('nop', 0, 0, self.n_array_vars or 0)
+        if self.n_registers is not None:
+            nop = ('nop', 0, 0, 0, 0)
+        segments = []
+        for address,instruction in enumerate(code):
+            if address in leaders or not segments or \
+               control(code[address - 1][0]):
+                segments.append([])
+            segments[-1].append(address)
+        replacements = {}
+        for segment in segments:
+            bundles = []
+            for address in segment:
+                x = accesses(code[address])
+                # writes happen after all reads of a bundle and in order
+                k = 0
+                for i,bundle in enumerate(bundles):
+                    if any(reads_result(y, x) for y in bundle.values()):
+                        k = i + 1
+                    elif any(overwrites(y, x) for y in bundle.values()):
+                        k = i
+                if control(code[address][0]):
+                    k = max(k, len(bundles) - 1)
+                while k < len(bundles) and len(bundles[k]) == bundle_width:
+                    k += 1
+                if k == len(bundles):
+                    bundles.append({})
+                bundles[k][address] = x
+            res = []
+            for bundle in bundles:
+                insts = [code[address] for address in sorted(bundle)]
+                insts[-1:-1] = [nop] * (bundle_width - len(insts))
+                res.append(tuple(tuple(x) for x in insts))
+            replacements[segment[0]] = res
+        for address,bb,i in self.code():
+            bb.instructions[i] = replacements.get(address, [])
+        self.rewrite(lambda instructions: instructions)
+        if verbose:
+            print('%d instructions in %d bundles of width %d' % \
+                  (len(code), self.length, bundle_width), file=sys.stderr)
+    def profile(self):
+        """ Run the final code in the clear with the global variables
+        set up like run_code() in machine.py and report where the
+        steps go. """
+        data = dict((x, 32 + i % 96) \
+                    for i,x in enumerate(self.global_cells()))
+        data.update(self.initial_data)
+        emulator = Emulator(self.get_code(), self.start, (), data, \
+                            self.initial_registers)
+        emulator.run(max_profile_steps)
+        ops = {}
+        functions = {}
+        blocks = {}
+        for address,bb,i in self.code():
+            n = emulator.counts.get(address, 0)
+            instruction = bb.instructions[i]
+            if isinstance(instruction[0], str):
+                instruction = [instruction]
+            for x in instruction:
+                ops[x[0]] = ops.get(x[0], 0) + n
+            name = bb.function.name
+            functions[name] = functions.get(name, 0) + n
+            blocks[name, bb.name] = blocks.get((name, bb.name), 0) + n
+        def report(title, counts):
+            print(title + ':', file=sys.stderr)
+            for x in sorted(counts, key=lambda x: -counts[x]):
+                if counts[x]:
+                    print('\t%d\t%s' % (counts[x], \
+                                         ':'.join(x) if isinstance(x, tuple) \
+                                         else x), file=sys.stderr)
+        print('%d steps%s' % (emulator.steps, '' if emulator.done() \
+                              else ' before stopping'), file=sys.stderr)
+        if emulator.done():
+            print('result: %d' % emulator.data.get(int(self.check), 0), \
+                  file=sys.stderr)
+        report('opcodes', ops)
+        report('functions', functions)
+        report('basic blocks', blocks)
+        print('%d of %d memory cells touched' % \
+              (len(emulator.touched), max(self.n_vars, self.N)), \
+              file=sys.stderr)
+    def infer_bit_lengths(self):
+        """ Bit length of the operands of every comparison and shift
+        opcode from the LLVM types of the cells involved, with pointers
+        as long as addresses. Values are signed as elsewhere, and a
+        truncation widens all types to its source because the machine
+        does not truncate. """
+        address_bits = \
+            int(max(self.n_vars, self.N, self.length)).bit_length() + 1
+        def type_width(t):
+            if isinstance(t, IntegerType):
+                return max(t.width, self.min_width)
+            elif isinstance(t, PointerType):
+                return address_bits
+        widths = {}
+        def widen(cell, width):
+            widths[cell] = max(widths.get(cell, 0), width or 64)
+        for var,value in self.vars.items():
+            if not value.direct:
+                widen(int(value), type_width(var.type))
+            elif isinstance(var.type, PointerType):
+                # the address is constant, the cells hold the pointee
+                size, t = get_size(var.type.pointee)
+                for i in range(size):
+                    widen(int(value) + i, type_width(t))
+        def operand_width(instruction, i):
+            x = instruction[i]
+            if i in memory_operands[instruction[0]][0]:
+                return widths.get(int(x), 64)
+            elif is_number(x):
+                return abs(x).bit_length() + 1
+            else:
+                return address_bits
+        for address,bb,i in self.code():
+            instruction = bb.instructions[i]
+            op = instruction[0]
+            if op in length_operands:
+                width = max(operand_width(instruction, j) \
+                            for j in length_operands[op])
+                self.bit_lengths[op] = max(self.bit_lengths.get(op, 0), \
+                                           min(width, 64))
+    def evaluate_prefix(self):
+        """ Run the program in the clear until it reads secret input,
+        that is, global variables not written before. """
+        tainted = [self.cell(x) \
+                   for x in range(max(self.n_global_vars, self.N)) \
+                   if self.cell(x) not in self.initial_data]
+        for address,length,party in self.inputs:
+            tainted.extend(range(address, address + length))
+        emulator = Emulator(self.get_code(), self.start, tainted, \
+                            self.initial_data, self.initial_registers)
+        emulator.run(max_prefix_steps)
+        self.start = emulator.PC
+        self.initial_data = emulator.data
+        self.initial_registers = emulator.registers
+        if verbose:
+            print('evaluated %d steps in the clear' % emulator.steps, \
+                  file=sys.stderr)
+    def write_image(self, filename):
+        """ Code image for machine.load_image(): magic, header (start,
+        check, n_vars, n_global_vars, number of entries, instructions
+        per entry, fields per instruction, length of the opcode names)
+        as 64-bit integers, a struct format character per field, the
+        opcode names, and the instructions with the index of the opcode
+        name first. Every field takes the fewest bytes that fit all of
+        its values. """
+        entries = [[entry] if isinstance(entry[0], str) else entry \
+                       for entry in self.get_code()]
+        names = sorted(set(inst[0] for entry in entries for inst in entry))
+        width = len(entries[0])
+        fields = max(len(inst) for entry in entries for inst in entry)
+        values = []
+        for entry in entries:
+            assert len(entry) == width
+            for inst in entry:
+                values.append(names.index(inst[0]))
+                values.extend(int(x) for x in inst[1:])
+                values.extend([0] * (fields - len(inst)))
+        formats = ''
+        for i in range(fields):
+            column = values[i::fields]
+            bits = max(max(column).bit_length(), (-min(column)).bit_length())
+            formats += 'bhiq'[max(0, (bits // 8).bit_length())]
+        names = '\n'.join(names).encode('ascii')
+        with open(filename, 'wb') as out:
+            out.write(b'C2MI')
+            out.write(struct.pack('<8q', self.start, self.check, \
+                                  max(self.n_vars, self.N), \
+                                  self.n_global_vars, len(entries), width, \
+                                  fields, len(names)))
+            out.write(formats.encode('ascii'))
+            out.write(names)
+            packer = struct.Struct('<' + formats)
+            for i in range(0, len(values), fields):
+                out.write(packer.pack(*values[i:i + fields]))
     def output(self):
         if not asm_output:
-            print('start =', self.main.start)
-            print('check =', repr(self.check))
-            print('n_vars =', max(self.n_vars, self.N))
-            print('n_global_vars =', self.n_global_vars)
+            if image_file:
+                self.write_image(image_file)
+                print('start, check, n_vars, n_global_vars, code = ' \
+                      'load_image(%r)' % image_file)
+            else:
+                print('start =', self.start)
+                print('check =', repr(self.check))
+                print('n_vars =', max(self.n_vars, self.N))
+                print('n_global_vars =', self.n_global_vars)
+            print('n_array_vars =', repr(self.n_array_vars))
+            # only needed if split_memory() moved them
+            print('global_cells =', repr(self.global_cells() \
+                                         if self.layout else None))
+            print('initial_data =', repr(self.initial_data))
+            print('n_registers =', repr(self.n_registers))
+            print('initial_registers =', repr(self.initial_registers))
+            print('bit_lengths =', repr(self.bit_lengths))
+            print('inputs =', repr(self.inputs))
+            if image_file:
+                return
             print('code = [')
         for function in self.functions:
             function.output()
@@ -532,7 +1765,7 @@ class Program(object):
         for v,x in self.vars.items():
             print(x, '\t', v, file=sys.stderr)
 
-opts, args = getopt(sys.argv[1:], 'aN:')
+opts, args = getopt(sys.argv[1:], 'aN:LPRT:OfW:EB:v')
 N = float('-inf')
 
 for opt,value in opts:
@@ -540,6 +1773,30 @@ for opt,value in opts:
         asm_output = True
     elif opt == '-N':
         N = int(value)
+    elif opt == '-L':
+        reuse_slots = False
+    elif opt == '-P':
+        evaluate_prefix = True
+    elif opt == '-R':
+        split_memory = True
+    elif opt == '-T':
+        n_registers = int(value)
+    elif opt == '-O':
+        optimize = True
+    elif opt == '-f':
+        fusion = True
+    elif opt == '-W':
+        bundle_width = int(value)
+    elif opt == '-E':
+        profile = True
+    elif opt == '-B':
+        image_file = value
+    elif opt == '-v':
+        verbose = True
 
-program = Program(Module.from_bitcode(open(args[0], 'rb')), N)
+if args[0].endswith('.ll'):
+    module = Module.from_assembly(open(args[0]))
+else:
+    module = Module.from_bitcode(open(args[0], 'rb'))
+program = Program(module, N)
 program.output()
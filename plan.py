@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+""" Preprocessing budget for a run of a program: MP-SPDZ counts the
+material of a program exactly if the number of steps is fixed
+(compile.sh -b), so compiling for one and for two steps separates the
+material per step from the material needed once. The number of steps
+is either given or taken from a cleartext dry run with mcompile.py -E
+on its placeholder data. """
+
+import sys
+import os
+import re
+import json
+import shutil
+import subprocess
+from getopt import getopt
+
+N = None
+flags = []
+steps = None
+mp_spdz = 'mp-spdz'
+compile_args = []
+output = 'plan'
+
+def run(args, **kwargs):
+    res = subprocess.run(args, stdout=subprocess.PIPE, \
+                         stderr=subprocess.STDOUT, universal_newlines=True, \
+                         **kwargs)
+    if res.returncode:
+        print(res.stdout, file=sys.stderr)
+        raise Exception('%s failed' % args[0])
+    return res.stdout
+
+def compile_sh(program, *args):
+    size = [] if N is None else ['-N', str(N)]
+    return run(['./compile.sh', '-C'] + flags + size + list(args) + \
+               [program])
+
+def dry_run(program):
+    """ Steps until the machine finds the program halted. """
+    out = compile_sh(program, '-a', '-e')
+    match = re.search(r'^(\d+) steps( before stopping)?$', out, re.M)
+    if match is None:
+        print(out, file=sys.stderr)
+        raise Exception('no step count in the output of the dry run')
+    if match.group(2):
+        raise Exception('the dry run stops at secret input, use -b')
+    return int(match.group(1)) + 1
+
+def requirements(program, n_steps):
+    """ Material listed by the MP-SPDZ compiler for a fixed number of
+    steps. """
+    source = os.path.join(mp_spdz, 'Programs', 'Source')
+    out = compile_sh(program, '-b', str(n_steps), '-o', source)
+    name = re.search(r'^name: (\S+)$', out, re.M).group(1)
+    out = run(['./compile.py'] + compile_args + [name], cwd=mp_spdz)
+    if 'Program requires:' not in out:
+        print(out, file=sys.stderr)
+        raise Exception('no "Program requires:" listing from compile.py')
+    res = {}
+    listing = out[out.index('Program requires:'):]
+    for number, kind in re.findall(r'^\s+(\d+|inf) (.+)$', listing, re.M):
+        if number == 'inf':
+            raise Exception('unbounded requirement: %s' % kind)
+        res[kind] = int(number)
+    return res
+
+opts, args = getopt(sys.argv[1:], 'N:f:b:m:c:o:')
+
+for opt,value in opts:
+    if opt == '-N':
+        N = int(value)
+    elif opt == '-f':
+        flags = value.split()
+    elif opt == '-b':
+        steps = int(value)
+    elif opt == '-m':
+        mp_spdz = value
+    elif opt == '-c':
+        compile_args = value.split()
+    elif opt == '-o':
+        output = value
+
+program, = args
+
+if steps is None:
+    steps = dry_run(program)
+    print('%d steps in the dry run' % steps, file=sys.stderr)
+
+# termination is only checked every k steps with compile.sh -k
+interval = re.search(r'-k\s*(\d+)', ' '.join(flags))
+if interval:
+    k = int(interval.group(1))
+    steps = -(-steps // k) * k
+
+# the material of the machine in this tree
+shutil.copy('machine.py', os.path.join(mp_spdz, 'Compiler'))
+
+one = requirements(program, 1)
+two = requirements(program, 2)
+kinds = sorted(set(one) | set(two))
+per_step = dict((x, two.get(x, 0) - one.get(x, 0)) for x in kinds)
+fixed = dict((x, one.get(x, 0) - per_step[x]) for x in kinds)
+total = dict((x, fixed[x] + steps * per_step[x]) for x in kinds)
+
+with open(output + '.json', 'w') as out:
+    json.dump({'program': program, 'N': N, 'flags': ' '.join(flags), \
+               'steps': steps, 'per step': per_step, 'fixed': fixed, \
+               'total': total}, out, indent=1, sort_keys=True)
+
+print('Budget for %d steps:' % steps)
+for x in kinds:
+    print('%12d %s' % (total[x], x))
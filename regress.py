@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+""" Regression test of mcompile.py: run every program in the clear
+(mcompile.py -E) under every combination of flags and compare the
+result with the one without optimization, fusion and slot sharing. """
+
+import sys
+import re
+import itertools
+import subprocess
+from getopt import getopt
+
+programs = ['pqueue_test.c', 'dijkstra.c', 'binsearch.c', 'sort.c', \
+            'strmatch.c', 'globals.c']
+N = 10
+# every combination of these is tested, with at most one of the
+# alternatives separated by |
+flags = ['-O', '-f', '-L', '-P', '-R', '-T 6', '-W 2|-W 3']
+reference = ['-L']
+compile_args = []
+timeout = 60
+
+def object_file(program):
+    """ Bitcode or textual IR of a C program from compile.sh. """
+    if program.endswith(('.o', '.ll')):
+        return program
+    res = subprocess.run(['./compile.sh', '-C', '-a', '-N', str(N)] + \
+                         compile_args + [program], \
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, \
+                         universal_newlines=True)
+    if res.returncode:
+        print(res.stderr, file=sys.stderr)
+        raise Exception('compile.sh failed on %s' % program)
+    return program[:-1] + ('ll' if '-S' in compile_args else 'o')
+
+def result(obj, flag_set):
+    args = ['./mcompile.py', '-a', '-E', '-N', str(N)] + \
+        sum((x.split() for x in flag_set), []) + [obj]
+    try:
+        res = subprocess.run(args, stdout=subprocess.DEVNULL, \
+                             stderr=subprocess.PIPE, \
+                             universal_newlines=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return 'timeout'
+    if res.returncode:
+        return 'error: ' + res.stderr.strip().split('\n')[-1]
+    match = re.search(r'^result: (.*)$', res.stderr, re.M)
+    return match.group(1) if match else 'not halted'
+
+opts, args = getopt(sys.argv[1:], 'N:f:c:t:')
+
+for opt,value in opts:
+    if opt == '-N':
+        N = int(value)
+    elif opt == '-f':
+        flags = value.split(',')
+    elif opt == '-c':
+        compile_args = value.split()
+    elif opt == '-t':
+        timeout = int(value)
+
+if args:
+    programs = args
+
+failures = 0
+for program in programs:
+    obj = object_file(program)
+    expected = result(obj, reference)
+    print('%s: %s' % (program, expected))
+    for choice in itertools.product(*([None] + x.split('|') for x in flags)):
+        flag_set = [x for x in choice if x]
+        res = result(obj, flag_set)
+        if res != expected:
+            failures += 1
+            print('%s %s: %s instead of %s' % \
+                  (program, ' '.join(flag_set), res, expected))
+
+print('%d failures' % failures)
+sys.exit(1 if failures else 0)
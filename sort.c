@@ -0,0 +1,34 @@
+#include <stdio.h>
+#include <signal.h>
+
+void debug_result(int* a) {
+#ifdef DEBUG
+  for (int i = 0; i < N; i++) {
+    printf("%d: %d\n", i, a[i]);
+    if (a[i] != i)
+      raise(SIGABRT);
+  }
+#endif
+}
+
+int main() {
+  int a[N];
+
+  // reversed input is the worst case for insertion sort
+  for (int i = 0; i < N; i++)
+    a[i] = N - 1 - i;
+
+  for (int i = 1; i < N; i++) {
+    int x = a[i];
+    int j = i;
+    while (j > 0 && a[j-1] > x) {
+      a[j] = a[j-1];
+      j--;
+    }
+    a[j] = x;
+  }
+
+  debug_result(a);
+
+  return a[N/2];
+}
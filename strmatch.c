@@ -0,0 +1,28 @@
+#include <stdio.h>
+#include <signal.h>
+
+const char pattern[] = "aab";
+
+int main() {
+  char text[N];
+
+  for (int i = 0; i < N; i++)
+    text[i] = i % 4 == 3 ? 'b' : 'a';
+
+  int count = 0;
+  for (int i = 0; i + sizeof(pattern) - 1 <= N; i++) {
+    int j = 0;
+    while (j < sizeof(pattern) - 1 && text[i+j] == pattern[j])
+      j++;
+    if (j == sizeof(pattern) - 1)
+      count++;
+  }
+
+#ifdef DEBUG
+  printf("%d matches\n", count);
+  if (count != (N + 1) / 4)
+    raise(SIGABRT);
+#endif
+
+  return count;
+}
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+""" Telemetry of a run: the report that machine.py writes when a
+program compiled with compile.sh -j is compiled by MP-SPDZ, completed
+with the steps and the time, data sent and rounds of the timer of each
+phase from the output of the MP-SPDZ run. """
+
+import sys
+import re
+import json
+
+def merge(report, out):
+    match = re.search(r'^Ticks: (\d+)$', out, re.M)
+    if match is None:
+        raise Exception('no "Ticks:" line in the output of the run')
+    report['steps'] = int(match.group(1))
+    timers = {}
+    for timer, seconds, sent, rounds in \
+        re.findall(r'^Time(\d+) = ([\d.e+-]+) seconds' \
+                   r'(?: \(([\d.e+-]+) MB(?:, (\d+) rounds)?\))?', \
+                   out, re.M):
+        timers[int(timer)] = {'seconds': float(seconds)}
+        if sent:
+            timers[int(timer)]['data sent'] = float(sent)
+        if rounds:
+            timers[int(timer)]['rounds'] = int(rounds)
+    report['phases'] = dict((phase, dict(timers.get(timer, {}), \
+                                         timer=timer)) \
+                            for phase,timer in report.pop('timers').items())
+    return report
+
+if len(sys.argv) not in (2, 3):
+    print('usage: %s <report> [<output of the run>]' % sys.argv[0], \
+          file=sys.stderr)
+    sys.exit(1)
+
+report = json.load(open(sys.argv[1]))
+out = open(sys.argv[2]).read() if len(sys.argv) == 3 else sys.stdin.read()
+json.dump(merge(report, out), sys.stdout, indent=1, sort_keys=True)
+print()